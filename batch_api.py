@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+import argparse
+from ter_lib import generate_ans, format_ans, get_llm, get_provider
+from result_store import JsonlResultWriter, read_jsonl, jsonl_to_json
+from run_file import find_lang_pair, read_txt, save_result, add_pipeline_args, setup_pipeline, pipeline_job_name
+
+# Offline batch execution of a run_file.py job through a provider batch API. Each stage renders
+# all its prompts to a JSONL request file, submits it as one batch, polls until it is done and
+# ingests the answers: translate for every segment, estimate for every translation, refine only
+# where "need correction" is 1. Everything is checkpointed under batch/<job>/, so a stopped job
+# resumes at the stage (and batch) where it stopped; a stage whose prompts or answer options changed
+# since its checkpoint is run again. LocalBatchBackend mimics the batch endpoint
+# with the models of ter_lib (e.g. -m fake) for offline runs.
+
+STAGES = ['translate', 'estimate', 'refine']
+DONE = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class OpenAIBatchBackend:
+    def __init__(self):
+        # Reads OPENAI_API_KEY
+        from openai import OpenAI
+        self.client = OpenAI()
+
+    def upload(self, path):
+        with open(path, 'rb') as f:
+            return self.client.files.create(file=f, purpose='batch').id
+
+    def create(self, file_id):
+        return self.client.batches.create(input_file_id=file_id, endpoint='/v1/chat/completions', completion_window='24h').id
+
+    def retrieve(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        return {'status': batch.status, 'output_file_id': batch.output_file_id, 'error_file_id': batch.error_file_id}
+
+    def download(self, file_id):
+        return self.client.files.content(file_id).text
+
+
+class LocalBatchBackend:
+    # Stand-in for the batch endpoint: files and batches live under `root`, a batch is answered
+    # with ter_lib.get_llm(model) when created and reported "in_progress" for `delay` seconds
+    def __init__(self, root, delay=0.0):
+        self.root = root
+        self.delay = delay
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, id):
+        return os.path.join(self.root, id)
+
+    def upload(self, path):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        with open(path, 'r', encoding='utf-8') as src, open(self.path(file_id), 'w', encoding='utf-8') as dst:
+            dst.write(src.read())
+        return file_id
+
+    def create(self, file_id):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        output_file_id = f"file-{uuid.uuid4().hex[:12]}"
+        with open(self.path(output_file_id), 'w', encoding='utf-8') as out:
+            for request in read_jsonl(self.path(file_id)):
+                out.write(json.dumps(self.answer(request), ensure_ascii=False) + '\n')
+        with open(self.path(batch_id), 'w', encoding='utf-8') as f:
+            json.dump({'created': time.time(), 'output_file_id': output_file_id}, f)
+        return batch_id
+
+    def answer(self, request):
+        body = request['body']
+        prompt = '\n'.join(message['content'] for message in body['messages'])
+        try:
+            content = get_llm(body['model']).invoke(input=prompt).content
+        except Exception as e:
+            return {'id': f"batch_req_{uuid.uuid4().hex[:12]}", 'custom_id': request['custom_id'], 'response': None,
+                    'error': {'code': type(e).__name__, 'message': str(e)}}
+        return {'id': f"batch_req_{uuid.uuid4().hex[:12]}", 'custom_id': request['custom_id'], 'error': None,
+                'response': {'status_code': 200, 'body': {'model': body['model'], 'choices': [
+                    {'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}]}}}
+
+    def retrieve(self, batch_id):
+        with open(self.path(batch_id), 'r', encoding='utf-8') as f:
+            batch = json.load(f)
+        if time.time() - batch['created'] < self.delay:
+            return {'status': 'in_progress', 'output_file_id': None, 'error_file_id': None}
+        return {'status': 'completed', 'output_file_id': batch['output_file_id'], 'error_file_id': None}
+
+    def download(self, file_id):
+        with open(self.path(file_id), 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+def write_jsonl(path, rows):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+    os.replace(tmp, path)
+
+
+def stage_digest(model, prompts, settings):
+    # Fingerprint of what a stage asks and of the settings its answers are read with
+    payload = json.dumps([model, settings, sorted(prompts.items())], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def run_stage(backend, work_dir, stage, module, prompts, parser, poll, settings=None):
+    # prompts: {id: prompt}. Returns {id: generate_ans-style answer}; checkpointed in <stage>.results.jsonl.
+    # settings: options that change how answers are read, e.g. the MQM policy of the estimate stage
+    results_path = os.path.join(work_dir, f"{stage}.results.jsonl")
+    digest_path = os.path.join(work_dir, f"{stage}.digest")
+    digest = stage_digest(module.model, prompts, settings)
+    if os.path.isfile(digest_path):
+        with open(digest_path, 'r', encoding='utf-8') as f:
+            if f.read().strip() != digest:
+                print(f"{stage}: prompts or options changed since the checkpoint, running the stage again")
+                for name in ('results.jsonl', 'batch.json', 'requests.jsonl'):
+                    path = os.path.join(work_dir, f"{stage}.{name}")
+                    if os.path.isfile(path):
+                        os.remove(path)
+    with open(digest_path, 'w', encoding='utf-8') as f:
+        f.write(digest)
+    if os.path.isfile(results_path):
+        print(f"{stage}: using checkpoint {results_path}")
+        return {row['id']: row['ans'] for row in read_jsonl(results_path)}
+    if not prompts:
+        write_jsonl(results_path, [])
+        return {}
+
+    model = module.model
+    state_path = os.path.join(work_dir, f"{stage}.batch.json")
+    if os.path.isfile(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        print(f"{stage}: resuming batch {state['batch_id']}")
+    else:
+        requests_path = os.path.join(work_dir, f"{stage}.requests.jsonl")
+        write_jsonl(requests_path, [{
+            "custom_id": f"{stage}-{id}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": [{"role": "user", "content": prompt}]},
+        } for id, prompt in prompts.items()])
+        file_id = backend.upload(requests_path)
+        state = {'batch_id': backend.create(file_id), 'input_file_id': file_id}
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        print(f"{stage}: submitted {len(prompts)} requests as batch {state['batch_id']}")
+
+    while True:
+        batch = backend.retrieve(state['batch_id'])
+        if batch['status'] in DONE:
+            break
+        print(f"{stage}: batch {state['batch_id']} is {batch['status']}, polling again in {poll}s")
+        time.sleep(poll)
+
+    answers = {}
+    if batch['output_file_id']:
+        for line in backend.download(batch['output_file_id']).splitlines():
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get('error') or not row.get('response') or row['response'].get('status_code') != 200:
+                continue
+            id = int(row['custom_id'].split('-', 1)[1])
+            ans = row['response']['body']['choices'][0]['message']['content']
+            try:
+                answers[id] = format_ans(stage, ans, parser.parse(ans))
+            except Exception as e:
+                print(f"{stage}: answer of segment {id} does not parse ({e})")
+
+    # Failed, expired or unparseable requests are asked again synchronously
+    missing = [id for id in prompts if id not in answers]
+    if missing:
+        print(f"{stage}: batch {batch['status']}, {len(missing)} requests redone synchronously")
+    for id in missing:
+        answers[id] = generate_ans(model, stage, prompts[id], parser)
+
+    write_jsonl(results_path, [{'id': id, 'ans': answers[id]} for id in sorted(answers)])
+    return answers
+
+
+def main():
+    parser = argparse.ArgumentParser('Run TEaR on a test set through a provider batch API')
+    parser.add_argument('-l', '--lang', type=str, default='zh-en', help='language pair - zhen, ende, enru')
+    parser.add_argument('-m', '--model', type=str, default='gpt-3.5-turbo', help='the model endpoint used for evaluation')
+    parser.add_argument('-ts', '--translate_strategy', type=str, default='few-shot', help='which prompting strategy is used in translating')
+    parser.add_argument('-es', '--estimate_strategy', type=str, default='few-shot', help='which prompting strategy is used in estimating')
+    parser.add_argument('-rs', '--refine_strategy', type=str, default='beta', help='which prompting strategy is used in refining')
+    parser.add_argument('--poll', type=float, default=60, help='seconds between batch status checks')
+    parser.add_argument('--local', action='store_true', help='use the local stand-in of the batch endpoint')
+    parser.add_argument('--local_delay', type=float, default=0.0, help='seconds a local batch stays in progress')
+    add_pipeline_args(parser, batch=True)
+    args = parser.parse_args()
+
+    src_lan, tgt_lan, src_path, ref_path = find_lang_pair(args.lang)
+    result_name = pipeline_job_name(args, args.lang, args.model, args.translate_strategy, args.estimate_strategy, args.refine_strategy)
+    work_dir = os.path.join('batch', os.path.basename(result_name))
+    os.makedirs(work_dir, exist_ok=True)
+
+    # Synchronous re-dos of failed batch requests still respect rate limits
+    pipeline = setup_pipeline(args, [args.model])
+    T, E, R = pipeline.modules(args.lang, args.model, args.translate_strategy, args.estimate_strategy, args.refine_strategy)
+    try:
+        if args.local:
+            backend = LocalBatchBackend(os.path.join(work_dir, 'local'), delay=args.local_delay)
+        else:
+            assert all(get_provider(module.model) == 'openai' for module in (T, E, R)), "the batch API is only available for openai models, use --local otherwise"
+            backend = OpenAIBatchBackend()
+
+        srcs = read_txt(src_path)
+        refs = read_txt(ref_path)
+        print(f"Loaded {len(srcs)} source segments!")
+        assert len(srcs) == len(refs), "please check src and ref files"
+        examples = {id: T.examples_for(src) for id, src in enumerate(srcs)}
+
+        # Translate
+        json_parser, json_output_instructions = T.set_parser()
+        prompts = {id: T.fill_prompt(src_lan, tgt_lan, src, json_output_instructions, examples[id]) for id, src in enumerate(srcs)}
+        hyps = run_stage(backend, work_dir, 'translate', T, prompts, json_parser, args.poll)
+
+        # Estimate
+        json_parser, json_output_instructions = E.set_parser()
+        prompts = {id: E.fill_prompt(src_lan, tgt_lan, src, json_output_instructions, examples[id], hyps[id]) for id, src in enumerate(srcs)}
+        estimates = run_stage(backend, work_dir, 'estimate', E, prompts, json_parser, args.poll, [args.refine_threshold, args.compact_mqm])
+
+        # Refine where necessary
+        json_parser, json_output_instructions = R.set_parser()
+        prompts = {id: R.fill_prompt(src_lan, tgt_lan, src, json_output_instructions, examples[id], hyps[id], estimates[id][0])
+                   for id, src in enumerate(srcs) if estimates[id][1] == 1}
+        cors = run_stage(backend, work_dir, 'refine', R, prompts, json_parser, args.poll)
+
+        output = f"{result_name}.jsonl"
+        with JsonlResultWriter(output) as writer:
+            for id, src in enumerate(srcs):
+                if id in writer:
+                    continue
+                mqm_info, nc = estimates[id]
+                save_result({'id': id, 'src': src, 'ref': refs[id], 'hyp': hyps[id], 'cor': cors.get(id, hyps[id]),
+                             'need correction': nc, 'mqm_info': mqm_info}, writer)
+                pipeline.metrics.record_segment(id, nc)
+        jsonl_to_json(output, f"{result_name}.json")
+        print(f"All {len(srcs)} segments saved to {result_name}.json")
+    finally:
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import re
+import sys
+import subprocess
+import argparse
+
+# Startup benchmark: runs `python -X importtime` on a statement in a fresh interpreter, without
+# API keys in the environment, and reports the total import time and the heaviest modules.
+# With the lazy provider imports in ter_lib, importing it loads no openai/langchain backend.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = {
+    'ter_lib': 'import ter_lib',
+    'fake-run': "import ter_lib; T = ter_lib.TEaR('zh-en', 'fake', 'translate', 'few-shot'); T.set_parser(); ter_lib.get_llm('fake')",
+    'run_file': 'import run_file',
+}
+HEAVY = ['openai', 'langchain_openai', 'langchain_google_genai', 'langchain_community', 'zhipuai']
+
+
+def importtime(statement):
+    # No *_API_KEY in the environment, so an import that needs a key fails here
+    env = {key: value for key, value in os.environ.items() if not key.endswith('_API_KEY')}
+    env['PYTHONPATH'] = ROOT
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=ROOT,
+                          env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if match:
+            modules.append((int(match.group(2)), len(match.group(3)), match.group(4)))
+    total = sum(cumulative for cumulative, depth, name in modules if depth == 1)
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser('Import-time benchmark of ter_lib')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per statement (best is reported)')
+    parser.add_argument('-t', '--top', type=int, default=8, help='number of heaviest top-level imports shown')
+    args = parser.parse_args()
+
+    for name, statement in STATEMENTS.items():
+        runs = [importtime(statement) for _ in range(args.repeat)]
+        total, modules = min(runs, key=lambda run: run[0])
+        loaded = set(module for _, _, module in modules)
+        heavy = [module for module in HEAVY if module in loaded]
+        print(f"{name}: {total / 1000:.1f} ms imports, provider backends loaded: {', '.join(heavy) or 'none'}")
+        top = sorted((module for module in modules if module[1] == 1), reverse=True)[:args.top]
+        for cumulative, _, module in top:
+            print(f"    {cumulative / 1000:8.1f} ms  {module}")
+
+
+if __name__ == '__main__':
+    main()
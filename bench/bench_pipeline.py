@@ -0,0 +1,138 @@
+import io
+import json
+import os
+import sys
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+from contextlib import redirect_stdout
+
+# End-to-end throughput benchmark of the run_file.py loop on the fake chat model: for every
+# dataset size and worker count, a fresh interpreter translates, estimates and refines synthetic
+# zh-en segments (the rand_200 sources, repeated) with ordered_map, run_tear_batch and the JSONL
+# writer, under the scheduler and metrics recorder. The fake model's latency distribution, rate
+# limit error share and refine ratio are configurable. Reports segments/sec, CPU time per segment
+# and peak RSS; --save keeps the numbers and --compare shows the change against a saved run.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+
+def run_job(config):
+    # One benchmark run; executed in a child process so that peak memory is per run
+    from ter_lib import TEaR, run_tear_batch, ordered_map, register_backend, set_scheduler, set_metrics
+    from scheduler import RequestScheduler
+    from metrics import MetricsRecorder
+    from result_store import JsonlResultWriter
+    from run_file import read_txt, find_lang_pair, save_result
+    from fake_llm import FakeChatModel
+
+    fake = config['fake']
+    register_backend('fake', ['fake'], lambda model, **kwargs: FakeChatModel(model, **dict(fake, **kwargs)))
+    scheduler = RequestScheduler(base_delay=0.01, max_delay=0.2, max_retries=20)
+    set_scheduler(scheduler)
+    metrics = MetricsRecorder()
+    set_metrics(metrics)
+
+    src_lan, tgt_lan, src_path, ref_path = find_lang_pair('zh-en')
+    base_srcs, base_refs = read_txt(src_path), read_txt(ref_path)
+    size = config['size']
+    # Numbered so that repeated sources are still different segments
+    srcs = [f"{base_srcs[i % len(base_srcs)]} ({i})" for i in range(size)]
+    refs = [f"{base_refs[i % len(base_refs)]} ({i})" for i in range(size)]
+    T = TEaR(lang_pair='zh-en', model='fake', module='translate', strategy='few-shot')
+    E = TEaR(lang_pair='zh-en', model='fake', module='estimate', strategy='few-shot')
+    R = TEaR(lang_pair='zh-en', model='fake', module='refine', strategy='beta')
+
+    batch = config['estimate_batch']
+    chunks = [list(range(size))[i:i + batch] for i in range(0, size, batch)]
+
+    def process(chunk):
+        results = run_tear_batch(T, E, R, src_lan, tgt_lan, [srcs[index] for index in chunk])
+        return [(index,) + result for index, result in zip(chunk, results)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        writer = JsonlResultWriter(os.path.join(tmp, 'bench.jsonl'))
+        cpu, start = time.process_time(), time.perf_counter()
+        # The pipeline prints as in a real run, into a buffer
+        with redirect_stdout(io.StringIO()):
+            for rows in ordered_map(process, chunks, workers=config['workers']):
+                for index, hyp, cor, nc, mqm_info in rows:
+                    save_result({'id': index, 'src': srcs[index], 'ref': refs[index], 'hyp': hyp, 'cor': cor,
+                                 'need correction': nc, 'mqm_info': mqm_info}, writer)
+                    metrics.record_segment(index, nc)
+        writer.close()
+        wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+        assert len(writer) == size, "missing segments"
+
+    summary = metrics.summary()
+    return {
+        "size": size,
+        "workers": config['workers'],
+        "segments_per_sec": round(size / wall, 2),
+        "cpu_ms_per_segment": round(cpu / size * 1000, 3),
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "refine_rate": summary['refine_rate'],
+        "calls": sum(stage['calls'] for stage in summary['stages'].values()),
+        "retries": scheduler.stats['retries'],
+    }
+
+
+def run_child(config):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+                          cwd=ROOT, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser('End-to-end throughput benchmark on the fake chat model')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200, 1000], help='numbers of segments')
+    parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 4, 16], help='worker counts')
+    parser.add_argument('-eb', '--estimate_batch', type=int, default=1, help='segments per estimate request')
+    parser.add_argument('--latency', type=float, default=0.01, help='median latency of a fake call in seconds')
+    parser.add_argument('--latency_dist', choices=['fixed', 'uniform', 'lognormal'], default='lognormal', help='latency distribution of the fake calls')
+    parser.add_argument('--latency_sigma', type=float, default=0.5, help='shape of the lognormal latency distribution')
+    parser.add_argument('--fail_ratio', type=float, default=0.01, help='share of fake calls failing with a retryable 429')
+    parser.add_argument('--refine_ratio', type=float, default=0.5, help='share of segments the fake estimate sends to refine')
+    parser.add_argument('--save', type=str, default='', help='write the results to this JSON file')
+    parser.add_argument('--compare', type=str, default='', help='show the change against results saved with --save')
+    parser.add_argument('--child', type=str, default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_job(json.loads(args.child))))
+        return
+
+    fake = {'latency': args.latency, 'latency_dist': args.latency_dist, 'latency_sigma': args.latency_sigma,
+            'fail_ratio': args.fail_ratio, 'error_ratio': args.refine_ratio}
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = {(result['size'], result['workers']): result for result in json.load(f)}
+
+    results = []
+    print(f"{'size':>6} {'workers':>7} {'seg/s':>9} {'cpu ms/seg':>10} {'peak MB':>8} {'refine':>6} {'calls':>6} {'retries':>7}")
+    for size in args.sizes:
+        for workers in args.workers:
+            result = run_child({'size': size, 'workers': workers, 'estimate_batch': args.estimate_batch, 'fake': fake})
+            results.append(result)
+            line = (f"{size:>6} {workers:>7} {result['segments_per_sec']:>9} {result['cpu_ms_per_segment']:>10} "
+                    f"{result['peak_rss_mb']:>8} {result['refine_rate']:>6} {result['calls']:>6} {result['retries']:>7}")
+            old = baseline.get((size, workers))
+            if old:
+                line += (f"   vs saved: seg/s {result['segments_per_sec'] / old['segments_per_sec'] - 1:+.0%}, "
+                         f"cpu/seg {result['cpu_ms_per_segment'] / old['cpu_ms_per_segment'] - 1:+.0%}")
+            print(line)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
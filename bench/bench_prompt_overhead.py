@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import argparse
+
+# Micro-benchmark of the per-segment CPU overhead of preparing TEaR prompts (no LLM calls).
+# "before" re-reads the few-shot examples, rebuilds the parsers and renders with PromptTemplate
+# for every segment, as run_file.py used to; "after" uses the cached examples/parsers and
+# the str.format fast path of TEaR.fill_prompt.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from ter_lib import TEaR
+
+
+def read_txt(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f]
+
+
+def before(T, E, R, src_lan, tgt_lan, src, hyp, mqm_info):
+    examples = T.read_examples()
+    _, instructions = T.build_parser()
+    T.template.format(src_lan=src_lan, tgt_lan=tgt_lan, examples=examples, origin=src.strip(), format_instructions=instructions)
+    _, instructions = E.build_parser()
+    E.template.format(src_lan=src_lan, tgt_lan=tgt_lan, origin=src.strip(), trans=hyp, format_instructions=instructions)
+    _, instructions = R.build_parser()
+    R.template.format(src_lan=src_lan, tgt_lan=tgt_lan, examples=examples, raw_src=src.strip(), raw_mt=hyp, sent_mqm=mqm_info, format_instructions=instructions)
+
+
+def after(T, E, R, src_lan, tgt_lan, src, hyp, mqm_info):
+    examples = T.load_examples()
+    _, instructions = T.set_parser()
+    T.fill_prompt(src_lan, tgt_lan, src, instructions, examples)
+    _, instructions = E.set_parser()
+    E.fill_prompt(src_lan, tgt_lan, src, instructions, examples, hyp)
+    _, instructions = R.set_parser()
+    R.fill_prompt(src_lan, tgt_lan, src, instructions, examples, hyp, mqm_info)
+
+
+def main():
+    parser = argparse.ArgumentParser('Per-segment prompt preparation overhead')
+    parser.add_argument('-l', '--lang', type=str, default='zh-en', help='language pair')
+    parser.add_argument('-n', '--segments', type=int, default=2000, help='number of segments')
+    args = parser.parse_args()
+
+    src_code, tgt_code = args.lang.split('-')
+    srcs = read_txt(f"dataset/mt/baseline/{src_code}{tgt_code}/test.{args.lang}.{src_code}")
+    srcs = (srcs * (args.segments // len(srcs) + 1))[:args.segments]
+    mqm_info = '{"critical": "no-error", "major": "accuracy/mistranslation - \\"x\\"", "minor": "no-error"}'
+
+    for name, func in [('before', before), ('after', after)]:
+        T = TEaR(lang_pair=args.lang, model='fake', module='translate', strategy='few-shot')
+        E = TEaR(lang_pair=args.lang, model='fake', module='estimate', strategy='few-shot')
+        R = TEaR(lang_pair=args.lang, model='fake', module='refine', strategy='beta')
+        start = time.process_time()
+        for src in srcs:
+            func(T, E, R, 'Source', 'Target', src, src, mqm_info)
+        cpu = time.process_time() - start
+        print(f"{name:>6}: {cpu / len(srcs) * 1e6:8.1f} us CPU per segment ({len(srcs)} segments)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import io
+import os
+import sys
+import time
+import argparse
+from contextlib import redirect_stdout
+
+# Tail-latency check of hedged requests: concurrent translate calls through generate_ans against
+# the fake chat model, where a share of the calls stalls. Runs the same calls without and with a
+# HedgePolicy and reports the latency percentiles. No API key or network access is needed.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from ter_lib import TEaR, generate_ans, ordered_map, set_hedge_policy
+from hedge import HedgePolicy
+from metrics import percentile
+
+
+def run(T, json_parser, json_output_instructions, args, tag):
+    fake = dict(latency=args.latency, slow_ratio=args.slow_ratio, slow_latency=args.slow_latency)
+
+    def call(i):
+        prompt = T.fill_prompt('Chinese', 'English', f'句子 {tag} {i}', json_output_instructions)
+        start = time.perf_counter()
+        ans = generate_ans('fake', 'translate', prompt, json_parser, **fake)
+        return ans, time.perf_counter() - start
+
+    start = time.time()
+    # generate_ans prints every prompt
+    with redirect_stdout(io.StringIO()):
+        results = list(ordered_map(call, range(args.requests), workers=args.workers))
+    elapsed = time.time() - start
+    assert [ans for ans, _ in results] == [f'[fake] 句子 {tag} {i}' for i in range(args.requests)], "wrong or missing answers"
+    walls = [wall for _, wall in results]
+    print(f"{tag}: {len(results)} calls in {elapsed:.2f}s, latency p50 {percentile(walls, 50):.3f}s "
+          f"p95 {percentile(walls, 95):.3f}s p99 {percentile(walls, 99):.3f}s max {max(walls):.3f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser('Hedged request check against a fake model with stalled calls')
+    parser.add_argument('-n', '--requests', type=int, default=400, help='number of translate calls')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='concurrent calls')
+    parser.add_argument('--latency', type=float, default=0.05, help='normal latency of the fake model')
+    parser.add_argument('--slow_ratio', type=float, default=0.05, help='share of stalled calls')
+    parser.add_argument('--slow_latency', type=float, default=2.0, help='latency of a stalled call')
+    parser.add_argument('--quantile', type=float, default=0.9, help='latency quantile used as hedge delay')
+    args = parser.parse_args()
+
+    T = TEaR(lang_pair='zh-en', model='fake', module='translate', strategy='zero-shot')
+    json_parser, json_output_instructions = T.set_parser()
+
+    run(T, json_parser, json_output_instructions, args, 'plain')
+    hedge = HedgePolicy(quantile=args.quantile, initial_delay=args.slow_latency / 4)
+    set_hedge_policy(hedge)
+    run(T, json_parser, json_output_instructions, args, 'hedged')
+    set_hedge_policy(None)
+    print(f"hedge: {hedge.summary()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import csv
+import glob
+import io
+import os
+import sys
+import time
+import argparse
+from contextlib import redirect_stdout
+
+# Benchmark of the estimate module against the human MQM annotations of dataset/mqm/<wmt>/<pair>/.
+# The annotated rows (src, system output, human MQM score) of *_final_file_filtered.csv are
+# streamed and identical (src, hyp) pairs of different systems are estimated only once; the
+# estimates run concurrently, are appended to result/mqm_bench/<wmt>_<pair>_<model>_<strategy>.jsonl
+# (a stopped run resumes there), and are scored as minus their weighted MQM error score.
+# Reports the call savings of deduplication, throughput, and segment- and system-level
+# Pearson / Kendall tau-b against the human scores.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from ter_lib import TEaR, estimate_pairs, ordered_map, set_scheduler, set_metrics, set_response_cache
+from scheduler import RequestScheduler
+from metrics import MetricsRecorder
+from llm_cache import ResponseCache
+from result_store import JsonlResultWriter, read_jsonl
+from run_file import find_lang_pair
+from mqm import parse_mqm_info, mqm_score
+
+
+def iter_rows(path):
+    # (system, src, hyp, human score) of every annotated row, read one at a time
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            yield row['system'], row['src'], row['hyps'], float(row['mqm_score'])
+
+
+def dedup(rows):
+    # Unique (src, hyp) pairs in order of appearance, and the (pair index, system, human score) of every row
+    pairs = {}
+    annotations = []
+    for system, src, hyp, score in rows:
+        index = pairs.setdefault((src, hyp), len(pairs))
+        annotations.append((index, system, score))
+    return list(pairs), annotations
+
+
+def pearson(xs, ys):
+    n = len(xs)
+    if n < 2:
+        return float('nan')
+    mx, my = sum(xs) / n, sum(ys) / n
+    cov = sum((x - mx) * (y - my) for x, y in zip(xs, ys))
+    vx = sum((x - mx) ** 2 for x in xs)
+    vy = sum((y - my) ** 2 for y in ys)
+    return cov / (vx * vy) ** 0.5 if vx and vy else float('nan')
+
+
+def kendall(xs, ys):
+    # Kendall tau-b, which accounts for the many ties of MQM scores
+    concordant = discordant = ties_x = ties_y = 0
+    for i in range(len(xs)):
+        for j in range(i + 1, len(xs)):
+            dx, dy = xs[i] - xs[j], ys[i] - ys[j]
+            if dx == 0 and dy == 0:
+                continue
+            if dx == 0:
+                ties_x += 1
+            elif dy == 0:
+                ties_y += 1
+            elif (dx > 0) == (dy > 0):
+                concordant += 1
+            else:
+                discordant += 1
+    denominator = ((concordant + discordant + ties_x) * (concordant + discordant + ties_y)) ** 0.5
+    return (concordant - discordant) / denominator if denominator else float('nan')
+
+
+def benchmark(path, args):
+    wmt, lang = path.split(os.sep)[-3:-1]
+    src_lan, tgt_lan = find_lang_pair(lang)[:2]
+    pairs, annotations = dedup(iter_rows(path))
+    if args.limit:
+        pairs = pairs[:args.limit]
+        annotations = [annotation for annotation in annotations if annotation[0] < args.limit]
+
+    E = TEaR(lang_pair=lang, model=args.model, module='estimate', strategy=args.estimate_strategy)
+    output = os.path.join(args.output, f"{wmt}_{lang}_{args.model}_{args.estimate_strategy}.jsonl")
+    writer = JsonlResultWriter(output)
+    pending = [index for index in range(len(pairs)) if index not in writer]
+    chunks = [pending[i:i + args.estimate_batch] for i in range(0, len(pending), args.estimate_batch)]
+
+    def process(chunk):
+        estimates = estimate_pairs(E, src_lan, tgt_lan, [pairs[index][0] for index in chunk], [pairs[index][1] for index in chunk])
+        return list(zip(chunk, estimates))
+
+    start = time.time()
+    try:
+        # estimate prompts are printed by generate_ans
+        with redirect_stdout(io.StringIO()):
+            for rows in ordered_map(process, chunks, workers=args.workers):
+                for index, (mqm_info, nc) in rows:
+                    writer.append({"id": index, "src": pairs[index][0], "hyp": pairs[index][1], "mqm_info": mqm_info, "need correction": nc})
+    finally:
+        writer.close()
+    elapsed = time.time() - start
+
+    predicted = {}
+    for entry in read_jsonl(output):
+        predicted[entry['id']] = -mqm_score(parse_mqm_info(entry['mqm_info'], entry['hyp']))
+    annotations = [annotation for annotation in annotations if annotation[0] in predicted]
+    human = [score for _, _, score in annotations]
+    machine = [predicted[index] for index, _, _ in annotations]
+
+    systems = {}
+    for (index, system, score), prediction in zip(annotations, machine):
+        systems.setdefault(system, ([], []))
+        systems[system][0].append(score)
+        systems[system][1].append(prediction)
+    system_human = [sum(scores) / len(scores) for scores, _ in systems.values()]
+    system_machine = [sum(predictions) / len(predictions) for _, predictions in systems.values()]
+
+    print(f"{wmt}/{lang}: {len(annotations)} annotated rows, {len(pairs)} unique pairs "
+          f"({1 - len(pairs) / max(1, len(annotations)):.0%} fewer estimate calls), {len(systems)} systems")
+    print(f"    estimated {len(pending)} pairs in {elapsed:.2f}s ({len(pending) / elapsed if elapsed > 0 else 0.0:.1f} pairs/s), "
+          f"{len(pairs) - len(pending)} from {output}")
+    print(f"    segment: pearson {pearson(machine, human):.3f} kendall {kendall(machine, human):.3f}")
+    print(f"    system:  pearson {pearson(system_machine, system_human):.3f} kendall {kendall(system_machine, system_human):.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser('Estimate-module benchmark against human MQM scores')
+    parser.add_argument('-d', '--data', type=str, default='dataset/mqm', help='folder with <wmt>/<pair>/*_final_file_filtered.csv')
+    parser.add_argument('-p', '--pairs', nargs='+', default=[], help='only these <wmt>/<pair>, e.g. wmt23/zh-en (default: all)')
+    parser.add_argument('-m', '--model', type=str, default='gpt-3.5-turbo', help='the model endpoint of the estimate module')
+    parser.add_argument('-es', '--estimate_strategy', type=str, default='few-shot', help='which prompting strategy is used in estimating')
+    parser.add_argument('-eb', '--estimate_batch', type=int, default=1, help='number of pairs estimated with one request')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='number of concurrent estimate requests')
+    parser.add_argument('--limit', type=int, default=0, help='only the first N unique pairs of each language pair')
+    parser.add_argument('--cache', type=str, default='', help='SQLite file caching LLM answers, e.g. cache/responses.sqlite')
+    parser.add_argument('--output', type=str, default='result/mqm_bench', help='folder of the estimate JSONL files')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.data, '*', '*', '*_final_file_filtered.csv')))
+    if args.pairs:
+        paths = [path for path in paths if '/'.join(path.split(os.sep)[-3:-1]) in args.pairs]
+    assert paths, f"no annotated MQM files found in {args.data}"
+
+    set_scheduler(RequestScheduler())
+    metrics = MetricsRecorder()
+    set_metrics(metrics)
+    cache = ResponseCache(args.cache) if args.cache else None
+    set_response_cache(cache)
+    try:
+        for path in paths:
+            benchmark(path, args)
+    finally:
+        if cache is not None:
+            cache.close()
+        metrics.print_summary()
+        metrics.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import time
+import argparse
+
+# Runs concurrent translate calls through generate_ans against a local fake OpenAI server
+# that answers a share of the requests with 429, and checks that the scheduler retries
+# them all. No API key or network access is needed.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from ter_lib import TEaR, generate_ans, ordered_map, set_scheduler
+from scheduler import RequestScheduler
+from fake_llm import FakeOpenAIServer
+
+
+def main():
+    parser = argparse.ArgumentParser('Retry/backoff check against a fake server returning 429s')
+    parser.add_argument('-n', '--requests', type=int, default=200, help='number of translate calls')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='concurrent calls')
+    parser.add_argument('--rate_limit_ratio', type=float, default=0.3, help='share of requests answered with 429')
+    parser.add_argument('--rpm', type=int, default=3000, help='requests/min allowed by the scheduler')
+    parser.add_argument('--tpm', type=int, default=0, help='tokens/min allowed by the scheduler (0: unlimited)')
+    args = parser.parse_args()
+
+    model = 'gpt-3.5-turbo'
+    T = TEaR(lang_pair='zh-en', model=model, module='translate', strategy='zero-shot')
+    json_parser, json_output_instructions = T.set_parser()
+    scheduler = RequestScheduler(limits={'openai': {'rpm': args.rpm, 'tpm': args.tpm}}, base_delay=0.05, max_delay=1.0, max_retries=20, cooldown=0.5)
+    set_scheduler(scheduler)
+
+    with FakeOpenAIServer(rate_limit_ratio=args.rate_limit_ratio) as server:
+        def call(i):
+            prompt = T.fill_prompt('Chinese', 'English', f'句子 {i}', json_output_instructions)
+            return generate_ans(model, 'translate', prompt, json_parser, base_url=server.url, api_key='fake')
+
+        start = time.time()
+        answers = list(ordered_map(call, range(args.requests), workers=args.workers))
+        elapsed = time.time() - start
+
+    assert answers == [f'[fake] 句子 {i}' for i in range(args.requests)], "wrong or missing answers"
+    print(f"{len(answers)} calls ok in {elapsed:.2f}s ({len(answers) / elapsed:.1f} calls/s)")
+    print(f"server: {server.requests} requests, {server.rate_limited} answered with 429")
+    print(f"scheduler: {scheduler.stats}")
+
+
+if __name__ == '__main__':
+    main()
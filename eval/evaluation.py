@@ -1,3 +1,20 @@
+import hashlib
+import os
+import sqlite3
+import argparse
+
+# Neural metrics are scored by a ScoringEngine: each metric model (COMET, COMET-Kiwi, BLEURT) is
+# loaded once and scores the segments of all systems in one length-sorted pass, and segment
+# scores are cached on disk by (metric, src, hyp, ref), so only changed outputs are re-scored.
+# Use device='cpu' (--cpu) on machines without a GPU.
+
+COMET_MODELS = {
+    "comet": "Unbabel/wmt22-comet-da",
+    "comet_kiwi": "Unbabel/wmt22-cometkiwi-da",
+}
+BLEURT_MODEL = 'lucadiliello/BLEURT-20'
+
+
 def get_chrfpp_score(hyps,refs):
     import sacrebleu
     assert len(hyps) == len(refs)
@@ -12,89 +29,205 @@ def get_bleu_score(hyps,refs,**kwargs,):
     print("sacrebleu:", round((score), 2))
     return score
 
-def get_comet_score(src,hyps,refs):
-    from comet import download_model, load_from_checkpoint
-    model_path = download_model("Unbabel/wmt22-comet-da")
-    model = load_from_checkpoint(model_path)
-    data = [
-        {
-            "src": s,
-            "mt": h,
-            "ref": r
-        }
-        for s,h,r in zip(src,hyps,refs)
-    ]
-    model_output = model.predict(data, batch_size=8, gpus=1)
-    print("comet:", round((model_output.system_score)*100, 2))
-    return model_output.system_score
-
-def get_comet_kiwi_score(src,hyps):
-    from comet import download_model, load_from_checkpoint
-    model_path = download_model("Unbabel/wmt22-cometkiwi-da")
-    model = load_from_checkpoint(model_path)
-    data = [
-        {
-            "src":s,
-            "mt":m,
-        }
-        for s,m in zip(src,hyps)
-    ]
-    model_output = model.predict(data, batch_size=8, gpus=1)
-    print("comet_kiwi:", round((model_output.system_score)*100,2))
-    return model_output.system_score
-
-def get_bleurt_score(hyps,refs,batch_size=8,device='cuda:0'):
-    # pip install git+https://github.com/lucadiliello/bleurt-pytorch.git
-    import torch
-    from bleurt_pytorch import BleurtConfig, BleurtForSequenceClassification, BleurtTokenizer
-
-    # config = BleurtConfig.from_pretrained('lucadiliello/BLEURT-20')
-    model = BleurtForSequenceClassification.from_pretrained('lucadiliello/BLEURT-20').to(device)
-    model.eval()
-    tokenizer = BleurtTokenizer.from_pretrained('lucadiliello/BLEURT-20')
-
-    hyps = [hyps[idx:idx+batch_size] for idx in range(0,len(hyps),batch_size)]
-    refs = [refs[idx:idx+batch_size] for idx in range(0,len(refs),batch_size)]
-
-    ret = []
-    for hyp,ref in zip(hyps,refs):
-        with torch.no_grad():
-            inputs = tokenizer(ref, hyp, padding='longest', return_tensors='pt', max_length=model.config.max_position_embeddings,truncation=True).to(device)
-            res = model(**inputs).logits.flatten().cpu().tolist()
-            ret.extend(res)
-    print("bleurt:", round((sum(ret)/len(ret))*100, 2))
-    return sum(ret)/len(ret)
-
-def eval_translation(src,hyps,refs,tokenize='flores200'):
+
+class SegmentScoreCache:
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores (metric TEXT, key TEXT, score REAL, PRIMARY KEY (metric, key))")
+
+    @staticmethod
+    def make_key(src, hyp, ref):
+        return hashlib.sha256('\0'.join([src or '', hyp or '', ref or '']).encode('utf-8')).hexdigest()
+
+    def get_many(self, metric, keys):
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(f"SELECT key, score FROM scores WHERE metric = ? AND key IN ({','.join('?' * len(chunk))})", [metric] + chunk)
+            found.update(rows.fetchall())
+        return found
+
+    def put_many(self, metric, scores):
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?)", [(metric, key, score) for key, score in scores.items()])
+
+
+class ScoringEngine:
+    def __init__(self, device='cuda:0', batch_size=8, cache_path='score_cache.sqlite'):
+        self.device = device
+        self.cpu = device == 'cpu'
+        self.batch_size = batch_size
+        self.models = {}
+        self.cache = SegmentScoreCache(cache_path) if cache_path else None
+
+    def load(self, metric):
+        # Each checkpoint is loaded once per engine
+        if metric not in self.models:
+            if metric in COMET_MODELS:
+                from comet import download_model, load_from_checkpoint
+                self.models[metric] = load_from_checkpoint(download_model(COMET_MODELS[metric]))
+            elif metric == 'bleurt':
+                # pip install git+https://github.com/lucadiliello/bleurt-pytorch.git
+                from bleurt_pytorch import BleurtForSequenceClassification, BleurtTokenizer
+                model = BleurtForSequenceClassification.from_pretrained(BLEURT_MODEL).to(self.device)
+                model.eval()
+                self.models[metric] = (model, BleurtTokenizer.from_pretrained(BLEURT_MODEL))
+            else:
+                raise AssertionError(f"unknown metric {metric}")
+        return self.models[metric]
+
+    def predict_comet(self, metric, segments):
+        model = self.load(metric)
+        if metric == 'comet_kiwi':
+            data = [{"src": s, "mt": h} for s, h, r in segments]
+        else:
+            data = [{"src": s, "mt": h, "ref": r} for s, h, r in segments]
+        if self.cpu:
+            model_output = model.predict(data, batch_size=self.batch_size, gpus=0, accelerator='cpu')
+        else:
+            # 'cuda:1' runs on GPU 1, plain 'cuda' on GPU 0, like the BLEURT model moved to self.device
+            index = int(self.device.split(':', 1)[1]) if ':' in self.device else 0
+            model_output = model.predict(data, batch_size=self.batch_size, gpus=1, devices=[index])
+        return list(model_output.scores)
+
+    def predict_bleurt(self, segments):
+        import torch
+        model, tokenizer = self.load('bleurt')
+        # Length-sorted batches need less padding; scores are put back in input order
+        order = sorted(range(len(segments)), key=lambda i: len(segments[i][1]) + len(segments[i][2]))
+        scores = [0.0] * len(segments)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            hyp = [segments[i][1] for i in batch]
+            ref = [segments[i][2] for i in batch]
+            with torch.no_grad():
+                inputs = tokenizer(ref, hyp, padding='longest', return_tensors='pt', max_length=model.config.max_position_embeddings, truncation=True).to(self.device)
+                res = model(**inputs).logits.flatten().cpu().tolist()
+            for i, score in zip(batch, res):
+                scores[i] = score
+        return scores
+
+    def segment_scores(self, metric, segments):
+        # Scores of (src, hyp, ref) triples; cached and duplicate segments are scored only once
+        if metric == 'comet_kiwi':
+            segments = [(s, h, '') for s, h, r in segments]
+        elif metric == 'bleurt':
+            segments = [('', h, r) for s, h, r in segments]
+        keys = [SegmentScoreCache.make_key(*segment) for segment in segments]
+        known = self.cache.get_many(metric, set(keys)) if self.cache else {}
+
+        todo = {}
+        for key, segment in zip(keys, segments):
+            if key not in known and key not in todo:
+                todo[key] = segment
+        if todo:
+            todo_segments = list(todo.values())
+            if metric == 'bleurt':
+                new_scores = self.predict_bleurt(todo_segments)
+            else:
+                new_scores = self.predict_comet(metric, todo_segments)
+            new_scores = dict(zip(todo.keys(), new_scores))
+            if self.cache:
+                self.cache.put_many(metric, new_scores)
+            known.update(new_scores)
+        print(f"{metric}: scored {len(todo)} new segments, {len(segments) - len(todo)} from cache or duplicates")
+        return [known[key] for key in keys]
+
+    def system_scores(self, metric, src, systems, refs):
+        # Mean segment score of every system, all systems scored in one pass
+        names = list(systems)
+        segments = [segment for name in names for segment in zip(src, systems[name], refs)]
+        scores = self.segment_scores(metric, segments)
+        result = {}
+        for i, name in enumerate(names):
+            system = scores[i * len(src):(i + 1) * len(src)]
+            result[name] = sum(system) / len(system)
+        return result
+
+
+# Engines used by the single-system helpers below, one per (device, batch size, cache). The helpers
+# only cache scores on disk when given a cache_path (or an engine that has one)
+default_engines = {}
+
+def get_engine(device='cuda:0', batch_size=8, cache_path=None):
+    key = (device, batch_size, cache_path)
+    if key not in default_engines:
+        default_engines[key] = ScoringEngine(device=device, batch_size=batch_size, cache_path=cache_path)
+    return default_engines[key]
+
+def get_comet_score(src,hyps,refs,batch_size=8,device='cuda:0',engine=None):
+    engine = engine or get_engine(device, batch_size)
+    score = engine.system_scores('comet', src, {'hyps': hyps}, refs)['hyps']
+    print("comet:", round((score)*100, 2))
+    return score
+
+def get_comet_kiwi_score(src,hyps,batch_size=8,device='cuda:0',engine=None):
+    engine = engine or get_engine(device, batch_size)
+    score = engine.system_scores('comet_kiwi', src, {'hyps': hyps}, [''] * len(hyps))['hyps']
+    print("comet_kiwi:", round((score)*100,2))
+    return score
+
+def get_bleurt_score(hyps,refs,batch_size=8,device='cuda:0',engine=None):
+    engine = engine or get_engine(device, batch_size)
+    score = engine.system_scores('bleurt', [''] * len(hyps), {'hyps': hyps}, refs)['hyps']
+    print("bleurt:", round((score)*100, 2))
+    return score
+
+def eval_translation(src,hyps,refs,tokenize='flores200',batch_size=8,device='cuda:0',engine=None):
     assert len(refs)==len(hyps)==len(src),f"len(refs)={len(refs)},len(hyps)={len(hyps)},len(src)={len(src)}"
+    engine = engine or get_engine(device, batch_size)
 
     return {
         "bleu":round(get_bleu_score(hyps,refs,tokenize=tokenize),2),
         "chrfpp":round(get_chrfpp_score(hyps,refs),2),
-        "comet":round(get_comet_score(src,hyps,refs)*100,2),
-        'comet_kiwi':round(get_comet_kiwi_score(src,hyps)*100,2),
-        "bleurt":round(get_bleurt_score(hyps,refs)*100,2),
+        "comet":round(get_comet_score(src,hyps,refs,engine=engine)*100,2),
+        'comet_kiwi':round(get_comet_kiwi_score(src,hyps,engine=engine)*100,2),
+        "bleurt":round(get_bleurt_score(hyps,refs,engine=engine)*100,2),
     }
-    
-    
+
+def eval_systems(engine, src, systems, refs, tokenize='flores200', metrics=('comet', 'comet_kiwi', 'bleurt')):
+    # Scores every system with every metric; each neural model is loaded once for all systems
+    for name, hyps in systems.items():
+        assert len(refs)==len(hyps)==len(src),f"{name}: len(refs)={len(refs)},len(hyps)={len(hyps)},len(src)={len(src)}"
+
+    results = {name: {} for name in systems}
+    for name, hyps in systems.items():
+        print(f"{name}:")
+        results[name]["bleu"] = round(get_bleu_score(hyps,refs,tokenize=tokenize),2)
+        results[name]["chrfpp"] = round(get_chrfpp_score(hyps,refs),2)
+    for metric in metrics:
+        for name, score in engine.system_scores(metric, src, systems, refs).items():
+            results[name][metric] = round(score*100,2)
+    return results
+
+
 def main():
-    
-    classname = "zh-en"
+    parser = argparse.ArgumentParser('Evaluate TEaR outputs')
+    parser.add_argument('-l', '--lang', type=str, default='zh-en', help='folder with src.txt, ref.txt and the system outputs')
+    parser.add_argument('-s', '--systems', nargs='+', default=['it', 'TEaR'], help='system output files (without .txt) to compare')
+    parser.add_argument('--metrics', nargs='+', default=['comet', 'comet_kiwi', 'bleurt'], help='neural metrics to compute')
+    parser.add_argument('--cpu', action='store_true', help='run the neural metrics on CPU')
+    parser.add_argument('--batch_size', type=int, default=8, help='batch size of the neural metrics')
+    parser.add_argument('--cache', type=str, default='score_cache.sqlite', help="segment score cache ('' to disable)")
+    args = parser.parse_args()
+
+    classname = args.lang
     src_path = f"{classname}/src.txt"
     ref_path = f"{classname}/ref.txt"
-    it_path = f"{classname}/it.txt"
-    tear_path = f"{classname}/TEaR.txt"
 
     src = open(src_path, 'r', encoding='utf-8').readlines()
     ref = open(ref_path, 'r', encoding='utf-8').readlines()
-    its = open(it_path, 'r', encoding='utf-8').readlines()
-    refines = open(tear_path, 'r', encoding='utf-8').readlines()
+    systems = {name: open(f"{classname}/{name}.txt", 'r', encoding='utf-8').readlines() for name in args.systems}
 
-    result_hyps1 = eval_translation(src, its, ref, 'flores200')
-    result_hyps2 = eval_translation(src, refines, ref, 'flores200')
+    engine = ScoringEngine(device='cpu' if args.cpu else 'cuda:0', batch_size=args.batch_size, cache_path=args.cache)
+    results = eval_systems(engine, src, systems, ref, 'flores200', args.metrics)
 
-    print("Initial Translation:\n", result_hyps1)
-    print("TEaR:\n", result_hyps2)
+    names = {"it": "Initial Translation"}
+    for name, result in results.items():
+        print(f"{names.get(name, name)}:\n", result)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
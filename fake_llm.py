@@ -0,0 +1,180 @@
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the chat models used by ter_lib. It answers every TEaR prompt with
+# JSON that the translate/estimate/refine parsers accept, so the pipeline can be run and
+# timed offline. Use it with `-m fake`, or register it under another name via
+# ter_lib.register_backend('fake', ['my-model'], FakeChatModel).
+
+
+class FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.response_metadata = {}
+
+
+def prompt_hash(prompt):
+    return int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16)
+
+
+def find_source(prompt):
+    # The last "Source:" line of a translate/refine prompt, or the "source:" line of an estimate prompt
+    found = re.findall(r'[Ss]ource: ?(.*)', prompt)
+    return found[-1].strip() if found else ''
+
+
+def json_block(ans_dict):
+    return "```json\n" + json.dumps(ans_dict, ensure_ascii=False, indent=4) + "\n```"
+
+
+class FakeRateLimitError(Exception):
+    # Raised for a share of the calls; retried by scheduler.RequestScheduler like a provider 429
+    status_code = 429
+
+
+class FakeChatModel:
+    def __init__(self, model='fake', latency=0.0, error_ratio=0.5, major_ratio=0.0, slow_ratio=0.0, slow_latency=10.0,
+                 latency_dist='fixed', latency_sigma=0.5, fail_ratio=0.0, **kwargs):
+        self.model = model
+        # latency is the median call latency; latency_dist 'fixed', 'uniform' (0 to 2x latency)
+        # or 'lognormal' (with shape latency_sigma, i.e. a long tail)
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        # Share of the calls that fail with FakeRateLimitError
+        self.fail_ratio = fail_ratio
+        # Share of the segments the estimate finds an error in, i.e. the refine ratio
+        self.error_ratio = error_ratio
+        # Share of the erroneous segments whose error is reported as major instead of minor
+        self.major_ratio = major_ratio
+        # A random share of the calls takes slow_latency instead, like a stalled provider request
+        self.slow_ratio = slow_ratio
+        self.slow_latency = slow_latency
+
+    def estimate(self, key, src):
+        # A deterministic share of the segments gets a minor error
+        draw = prompt_hash(key) % 1000
+        if draw < self.error_ratio * self.major_ratio * 1000:
+            return {"critical": "no-error", "major": 'accuracy/mistranslation - "%s"' % src[:20], "minor": "no-error"}
+        if draw < self.error_ratio * 1000:
+            return {"critical": "no-error", "major": "no-error", "minor": 'style/awkward - "%s"' % src[:20]}
+        return {"critical": "no-error", "major": "no-error", "minor": "no-error"}
+
+    def answer(self, prompt):
+        src = find_source(prompt)
+        # Refine prompts quote the estimate output, so they are recognised first
+        if '"Final Target"' in prompt:
+            return json_block({"Final Target": f"[{self.model} refined] {src}"})
+        if '"annotations"' in prompt:
+            # Batched estimate: one annotation per numbered pair
+            pairs = re.findall(r'^\[(\d+)\]\n.*source: ?(.*)\n(.*)', prompt, flags=re.M)
+            return json_block({"annotations": [dict(id=int(i), **self.estimate(src + hyp, src)) for i, src, hyp in pairs]})
+        if '"critical"' in prompt:
+            return json_block(self.estimate(prompt, src))
+        return json_block({"Target": f"[{self.model}] {src}"})
+
+    def sample_latency(self):
+        if self.slow_ratio and random.random() < self.slow_ratio:
+            return self.slow_latency
+        if not self.latency or self.latency_dist == 'fixed':
+            return self.latency
+        if self.latency_dist == 'uniform':
+            return random.uniform(0, 2 * self.latency)
+        if self.latency_dist == 'lognormal':
+            return random.lognormvariate(math.log(self.latency), self.latency_sigma)
+        raise ValueError(f"unknown latency distribution {self.latency_dist}")
+
+    def invoke(self, input, **kwargs):
+        latency = self.sample_latency()
+        if latency:
+            time.sleep(latency)
+        if self.fail_ratio and random.random() < self.fail_ratio:
+            raise FakeRateLimitError(f"{self.model}: rate limited")
+        return FakeMessage(self.answer(input))
+
+
+class FakeOpenAIServer:
+    # A local HTTP server speaking the OpenAI chat completions API, answered by FakeChatModel.
+    # `rate_limit_ratio` of the requests (and every request while `rate_limit_until` has not
+    # passed) get a 429, so retry/backoff can be exercised without a real endpoint.
+    # Point a client at it with base_url=server.url, e.g.
+    # generate_ans('gpt-3.5-turbo', ..., base_url=server.url, api_key='fake')
+    def __init__(self, port=0, latency=0.0, error_ratio=0.5, rate_limit_ratio=0.0, rate_limit_until=0.0, retry_after=None):
+        self.model = FakeChatModel(latency=latency, error_ratio=error_ratio)
+        self.rate_limit_ratio = rate_limit_ratio
+        self.rate_limit_until = rate_limit_until
+        self.retry_after = retry_after
+        self.requests = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, code, body, headers=None):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                code, answer, headers = server.handle(body)
+                self.send_json(code, answer, headers)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def handle(self, body):
+        with self.lock:
+            self.requests += 1
+            limited = time.monotonic() < self.rate_limit_until or random.random() < self.rate_limit_ratio
+            if limited:
+                self.rate_limited += 1
+        if limited:
+            headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else {}
+            return 429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, headers
+
+        prompt = '\n'.join(message.get('content', '') for message in body.get('messages', []))
+        content = self.model.invoke(prompt).content
+        usage = {"prompt_tokens": len(prompt) // 3 + 1, "completion_tokens": len(content) // 3 + 1}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return 200, {
+            "id": f"chatcmpl-fake{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get('model', 'fake'),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }, {}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
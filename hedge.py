@@ -0,0 +1,162 @@
+import math
+import queue
+import threading
+import time
+
+# Hedged LLM requests. When a request has not answered after the hedge delay, a duplicate is sent
+# (to the same model, or to a fallback model, possibly of another provider) and the first answer
+# wins; a request that fails outright is hedged at once. The delay of a provider is a high
+# quantile of its recent latencies, so only its slowest requests get a duplicate. Python cannot
+# interrupt a request in flight: the losing request is abandoned and its answer dropped, but its
+# latency still goes into the histogram and its tokens into the metrics. Time spent waiting in
+# the scheduler for quota or backoff does not count towards the delay. Install a HedgePolicy
+# with ter_lib.set_hedge_policy.
+
+
+class LatencyHistogram:
+    # Log-spaced buckets from 10ms (x1.25 per bucket, ~250s at the top)
+    BASE = 0.01
+    FACTOR = 1.25
+    BUCKETS = 48
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def bucket(self, seconds):
+        if seconds <= self.BASE:
+            return 0
+        return min(self.BUCKETS - 1, int(math.log(seconds / self.BASE, self.FACTOR)) + 1)
+
+    def record(self, seconds):
+        with self.lock:
+            self.counts[self.bucket(seconds)] += 1
+            self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile
+        with self.lock:
+            if self.count == 0:
+                return None
+            rank = q * self.count
+            seen = 0
+            for i, count in enumerate(self.counts):
+                seen += count
+                if seen >= rank:
+                    return self.BASE * self.FACTOR ** i
+            return self.BASE * self.FACTOR ** (self.BUCKETS - 1)
+
+
+class HedgePolicy:
+    def __init__(self, fallback=None, quantile=0.95, initial_delay=10.0, min_delay=0.2, max_delay=60.0, min_samples=20):
+        # fallback: model of the duplicate request (None: the same model)
+        self.fallback = fallback
+        self.quantile = quantile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.min_samples = min_samples
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'failovers': 0}
+
+    def histogram(self, provider):
+        with self.lock:
+            if provider not in self.histograms:
+                self.histograms[provider] = LatencyHistogram()
+            return self.histograms[provider]
+
+    def delay(self, provider):
+        # Hedge delay of the provider; initial_delay until enough latencies are known
+        histogram = self.histogram(provider)
+        if histogram.count < self.min_samples:
+            return self.initial_delay
+        return min(self.max_delay, max(self.min_delay, histogram.quantile(self.quantile)))
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def call(self, model, provider, func, hedge_model, hedge_provider, abandoned=None):
+        # func(model, on_attempt) -> (message, info); returns the first answer of model, or of
+        # hedge_model when model is slower than the hedge delay or fails. info gains 'answered_by'.
+        # The hedge delay counts only while the primary request holds a slot of the scheduler
+        # (func calls on_attempt(True) then, on_attempt(False) when it backs off), so requests
+        # waiting for quota are not duplicated. abandoned(model, message, info, wall) is called
+        # for every answer that lost.
+        self.count('requests')
+        answers = queue.Queue()
+        lock = threading.Lock()
+        state = {'done': False}
+
+        def attempt(name, model, provider):
+            def on_attempt(active):
+                if name == 'primary':
+                    answers.put(('clock', active))
+
+            start = time.perf_counter()
+            try:
+                message, info = func(model, on_attempt)
+            except Exception as e:
+                answers.put((name, model, None, None, e, None))
+                return
+            wall = time.perf_counter() - start
+            self.histogram(provider).record(wall - info['queue_wait'])
+            with lock:
+                if not state['done']:
+                    answers.put((name, model, message, info, None, wall))
+                    return
+            if abandoned is not None:
+                abandoned(model, message, info, wall)
+
+        threading.Thread(target=attempt, args=('primary', model, provider), daemon=True).start()
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            try:
+                result = answers.get(timeout=timeout)
+            except queue.Empty:
+                result = None
+                break
+            if result[0] != 'clock':
+                break
+            deadline = time.perf_counter() + self.delay(provider) if result[1] else None
+        if result is not None and result[4] is None:
+            return self.finish(result, answers, lock, state, abandoned)
+
+        # Too slow or failed: send the duplicate, then take the first answer that succeeds
+        self.count('hedged' if result is None else 'failovers')
+        threading.Thread(target=attempt, args=('hedge', hedge_model, hedge_provider), daemon=True).start()
+        errors = [] if result is None else [result[4]]
+        while len(errors) < 2:
+            result = answers.get()
+            if result[0] == 'clock':
+                continue
+            if result[4] is None:
+                if result[0] == 'hedge':
+                    self.count('hedge_wins')
+                return self.finish(result, answers, lock, state, abandoned)
+            errors.append(result[4])
+        raise errors[0]
+
+    def finish(self, result, answers, lock, state, abandoned):
+        with lock:
+            state['done'] = True
+        # An answer that came in together with the winner lost as well
+        while True:
+            try:
+                other = answers.get_nowait()
+            except queue.Empty:
+                break
+            if other[0] != 'clock' and other[4] is None and abandoned is not None:
+                abandoned(*other[1:4], other[5])
+        name, model, message, info, error, wall = result
+        return message, dict(info, answered_by=model)
+
+    def summary(self):
+        with self.lock:
+            stats = dict(self.stats)
+            providers = list(self.histograms)
+        stats['delay'] = {provider: round(self.delay(provider), 3) for provider in providers}
+        return stats
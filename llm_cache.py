@@ -0,0 +1,73 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# On-disk cache of raw LLM answers for generate_ans, keyed by (model, module, rendered prompt,
+# decoding params). Re-running a job with another refine strategy then only pays for the
+# stage whose prompts changed. Least recently used entries are evicted above max_entries.
+
+
+class ResponseCache:
+    def __init__(self, path='cache/responses.sqlite', max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, model TEXT, module TEXT, response TEXT, last_used REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, module, prompt, params=None):
+        raw = json.dumps([model, module, prompt, params or {}], ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, model, module, response):
+        with self.lock:
+            exists = self.conn.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (key, model, module, response, time.time()))
+            if exists is None:
+                self.entries += 1
+            if self.entries > self.max_entries:
+                self.evict()
+
+    def evict(self):
+        # Drop the least recently used tenth, so eviction does not run on every put
+        keep = int(self.max_entries * 0.9)
+        self.conn.execute("""DELETE FROM responses WHERE key IN (
+            SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)""", (self.entries - keep,))
+        self.entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entries": self.entries,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-call metrics of the TEaR pipeline. generate_ans reports one record per translate/
+# estimate/refine call (wall time, queue wait, tokens, retries, parse failures, cache hits),
+# run_file.py one record per finished segment; records are kept in memory for the end-of-run
+# summary and optionally appended to a JSONL file.
+
+# Approximate list prices in USD per 1M (prompt, completion) tokens, used for cost estimates
+MODEL_PRICES = {
+    'gpt-4': (30.0, 60.0),
+    'gpt-4o': (5.0, 15.0),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4-1106-preview': (10.0, 30.0),
+    'gpt-3.5-turbo-0613': (1.5, 2.0),
+    'gpt-3.5-turbo': (0.5, 1.5),
+    'gemini-pro': (0.5, 1.5),
+    'glm-4-0520': (14.0, 14.0),
+    'glm-4-air': (0.14, 0.14),
+    'fake': (0.0, 0.0),
+}
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return ((prompt_tokens or 0) * prompt_price + (completion_tokens or 0) * completion_price) / 1e6
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class MetricsRecorder:
+    def __init__(self, path=None):
+        self.path = path
+        self.calls = []
+        self.segments = []
+        self.routes = []
+        # Call records collected for the current thread, see collect
+        self.local = threading.local()
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.file = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def record_call(self, stage, model, wall, queue_wait=0.0, prompt_tokens=0, completion_tokens=0,
+                    retries=0, parse_failure=False, cache_hit=False, **extra):
+        record = {
+            "type": "call",
+            "time": round(time.time(), 3),
+            "stage": stage,
+            "model": model,
+            "wall": round(wall, 4),
+            "queue_wait": round(queue_wait, 4),
+            "prompt_tokens": prompt_tokens or 0,
+            "completion_tokens": completion_tokens or 0,
+            "retries": retries,
+            "parse_failure": parse_failure,
+            "cache_hit": cache_hit,
+            "cost": 0.0 if cache_hit else round(call_cost(model, prompt_tokens, completion_tokens), 6),
+        }
+        record.update(extra)
+        with self.lock:
+            self.calls.append(record)
+            self.write(record)
+        collected = getattr(self.local, 'calls', None)
+        if collected is not None:
+            collected.append(record)
+
+    @contextmanager
+    def collect(self):
+        # Yields the list of call records this thread makes inside the block, e.g. to cost a routing decision
+        outer = getattr(self.local, 'calls', None)
+        self.local.calls = calls = []
+        try:
+            yield calls
+        finally:
+            self.local.calls = outer
+            if outer is not None:
+                outer.extend(calls)
+
+    def record_route(self, stage, route, wall, calls, cost, **extra):
+        # One record per segment and routing decision of a model cascade (calls may be a share of a batched call)
+        record = {"type": "route", "time": round(time.time(), 3), "stage": stage, "route": route,
+                  "wall": round(wall, 4), "calls": round(calls, 3), "cost": round(cost, 6)}
+        record.update(extra)
+        with self.lock:
+            self.routes.append(record)
+            self.write(record)
+
+    def record_segment(self, id, nc, **extra):
+        record = {"type": "segment", "time": round(time.time(), 3), "id": id, "need correction": nc}
+        record.update(extra)
+        with self.lock:
+            self.segments.append(record)
+            self.write(record)
+
+    def summary(self):
+        with self.lock:
+            calls = list(self.calls)
+            segments = list(self.segments)
+            routes = list(self.routes)
+        stages = {}
+        for stage in sorted(set(call['stage'] for call in calls)):
+            stage_calls = [call for call in calls if call['stage'] == stage]
+            walls = [call['wall'] for call in stage_calls]
+            waits = [call['queue_wait'] for call in stage_calls]
+            stages[stage] = {
+                "calls": len(stage_calls),
+                "wall_p50": round(percentile(walls, 50), 3),
+                "wall_p95": round(percentile(walls, 95), 3),
+                "queue_wait_p50": round(percentile(waits, 50), 3),
+                "queue_wait_p95": round(percentile(waits, 95), 3),
+                "prompt_tokens": sum(call['prompt_tokens'] for call in stage_calls),
+                "completion_tokens": sum(call['completion_tokens'] for call in stage_calls),
+                "retries": sum(call['retries'] for call in stage_calls),
+                "parse_failures": sum(call['parse_failure'] for call in stage_calls),
+                "cache_hits": sum(call['cache_hit'] for call in stage_calls),
+                "cost": round(sum(call['cost'] for call in stage_calls), 4),
+            }
+        decisions = {}
+        for name in sorted(set((route['stage'], route['route']) for route in routes)):
+            decision = [route for route in routes if (route['stage'], route['route']) == name]
+            walls = [route['wall'] for route in decision]
+            decisions['/'.join(name)] = {
+                "segments": len(decision),
+                "calls": round(sum(route['calls'] for route in decision), 1),
+                "wall_p50": round(percentile(walls, 50), 3),
+                "wall_p95": round(percentile(walls, 95), 3),
+                "cost": round(sum(route['cost'] for route in decision), 4),
+            }
+        total_cost = sum(call['cost'] for call in calls)
+        elapsed = time.time() - self.start
+        return {
+            "segments": len(segments),
+            "elapsed": round(elapsed, 2),
+            "segments_per_sec": round(len(segments) / elapsed, 3) if elapsed > 0 else 0.0,
+            "refine_rate": round(sum(segment['need correction'] for segment in segments) / len(segments), 4) if segments else 0.0,
+            "cost": round(total_cost, 4),
+            "cost_per_segment": round(total_cost / len(segments), 6) if segments else 0.0,
+            "stages": stages,
+            "routes": decisions,
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"----------------(╹ڡ╹ )---------Metrics---------o(*￣▽￣*)ブ-----------------")
+        print(f"Segments: {summary['segments']} in {summary['elapsed']}s ({summary['segments_per_sec']} seg/s)")
+        print(f"Refine rate: {summary['refine_rate']}")
+        print(f"Cost: ${summary['cost']} (${summary['cost_per_segment']} per segment)")
+        for stage, stats in summary['stages'].items():
+            print(f"{stage:>15}: {stats['calls']} calls, wall p50 {stats['wall_p50']}s p95 {stats['wall_p95']}s, "
+                  f"queue p50 {stats['queue_wait_p50']}s p95 {stats['queue_wait_p95']}s, "
+                  f"tokens {stats['prompt_tokens']}+{stats['completion_tokens']}, retries {stats['retries']}, "
+                  f"parse failures {stats['parse_failures']}, cache hits {stats['cache_hits']}")
+        for route, stats in summary['routes'].items():
+            print(f"{route:>28}: {stats['segments']} segments, {stats['calls']} calls, "
+                  f"wall p50 {stats['wall_p50']}s p95 {stats['wall_p95']}s, cost ${stats['cost']}")
+        return summary
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
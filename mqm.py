@@ -0,0 +1,116 @@
+import json
+import re
+from collections import namedtuple
+
+# Typed MQM annotations. The estimate answer ({"critical": ..., "major": ..., "minor": ...}, each
+# value a free-form list like `accuracy/omission - "the account holder"` or "no-error") is parsed
+# into MQMError records. An MQMPolicy (ter_lib.set_mqm_policy) then decides "need correction" from
+# the severity-weighted error score instead of "any error", and can replace the raw answer in
+# mqm_info and the refine prompt with the compact form:
+#     major: accuracy/mistranslation "involvement"; accuracy/omission "the account holder"
+#     minor: fluency/grammar "wäre"
+
+SEVERITIES = ('critical', 'major', 'minor')
+# MQM weights as used for the WMT human annotations (critical errors count double a major one)
+SEVERITY_WEIGHTS = {'critical': 10, 'major': 5, 'minor': 1}
+NO_ERROR = {'', 'no-error', 'no error', 'none', 'null', 'n/a'}
+
+# start/end are character offsets of span in the translation, -1 if unknown or not found
+MQMError = namedtuple('MQMError', ['severity', 'category', 'span', 'start', 'end'])
+
+# A span may hold quotes escaped with a backslash: accuracy/mistranslation "he said \"hi\""
+ERROR_PATTERN = re.compile(r'([a-z][a-z\- ]*(?:/[a-z][a-z\- ]*)?)\s*-?\s*["“]((?:\\.|[^"”\\\n])*)["”]', re.IGNORECASE)
+LINE_PATTERN = re.compile(r'^\s*(critical|major|minor)\s*:\s*(.*)$', re.IGNORECASE)
+
+
+def is_no_error(value):
+    return value is None or str(value).strip().strip('.').lower() in NO_ERROR
+
+
+def parse_errors(severity, value, hyp=None):
+    # MQMErrors of one severity; an answer without quoted spans is kept as one error without span
+    if isinstance(value, (list, tuple)):
+        return [error for item in value for error in parse_errors(severity, item, hyp)]
+    if is_no_error(value):
+        return []
+    value = str(value)
+    errors = []
+    for match in ERROR_PATTERN.finditer(value):
+        category, span = match.group(1).strip(' -').lower(), re.sub(r'\\(.)', r'\1', match.group(2))
+        if category in NO_ERROR:
+            continue
+        errors.append(MQMError(severity, category, span, *locate(span, hyp)))
+    if not errors:
+        errors.append(MQMError(severity, value.strip().strip('"').lower(), '', -1, -1))
+    return errors
+
+
+def locate(span, hyp):
+    if not span or hyp is None:
+        return -1, -1
+    start = hyp.find(span)
+    return (start, start + len(span)) if start >= 0 else (-1, -1)
+
+
+def parse_mqm(ans_dict, hyp=None):
+    # MQMErrors of a parsed estimate answer, in severity order
+    ans_dict = {str(key).lower(): value for key, value in ans_dict.items()}
+    return [error for severity in SEVERITIES for error in parse_errors(severity, ans_dict.get(severity), hyp)]
+
+
+def parse_compact(text, hyp=None):
+    # Inverse of to_compact; also reads "critical: ..." lines of a raw answer
+    ans_dict = {}
+    for line in text.splitlines():
+        match = LINE_PATTERN.match(line)
+        if match:
+            ans_dict[match.group(1).lower()] = match.group(2)
+    return parse_mqm(ans_dict, hyp)
+
+
+def parse_mqm_info(mqm_info, hyp=None):
+    # MQMErrors of an mqm_info as stored in results: a raw or batched estimate answer (JSON) or the compact form
+    start, end = mqm_info.find('{'), mqm_info.rfind('}')
+    if 0 <= start < end:
+        try:
+            ans_dict = json.loads(mqm_info[start:end + 1])
+        except ValueError:
+            ans_dict = None
+        if isinstance(ans_dict, dict):
+            return parse_mqm(ans_dict, hyp)
+    return parse_compact(mqm_info, hyp)
+
+
+def escape(span):
+    return span.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def to_compact(errors):
+    lines = []
+    for severity in SEVERITIES:
+        items = [f'{error.category} "{escape(error.span)}"' if error.span else error.category for error in errors if error.severity == severity]
+        if items:
+            lines.append(f"{severity}: {'; '.join(items)}")
+    return '\n'.join(lines) or 'no-error'
+
+
+def mqm_score(errors, weights=SEVERITY_WEIGHTS):
+    return sum(weights[error.severity] for error in errors)
+
+
+class MQMPolicy:
+    def __init__(self, threshold=1, weights=SEVERITY_WEIGHTS, compact=True):
+        # A segment is refined when its weighted error score reaches threshold: 1 refines on any
+        # error (the default behaviour), 5 skips segments with fewer than five minor errors only
+        self.threshold = threshold
+        self.weights = weights
+        self.compact = compact
+
+    def need_correction(self, errors):
+        return 1 if mqm_score(errors, self.weights) >= self.threshold else 0
+
+    def apply(self, ans, ans_dict):
+        # (mqm_info, nc) of an estimate answer. The translation is not known here, so span offsets
+        # are left at -1; parse_mqm_info(mqm_info, hyp) finds them in a saved result
+        errors = parse_mqm(ans_dict)
+        return (to_compact(errors) if self.compact else ans), self.need_correction(errors)
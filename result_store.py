@@ -0,0 +1,153 @@
+import json
+import os
+import sys
+import argparse
+from shard import shard_output
+
+# Append-only JSONL storage for run_file.py results. Each finished segment is one line,
+# so saving a segment costs O(1) instead of re-dumping the whole result file, and the
+# set of finished ids is kept in memory for resuming.
+
+
+def read_jsonl(path):
+    entries = []
+    if not os.path.isfile(path):
+        return entries
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # A line torn by a crash mid-write; that segment is simply redone
+                continue
+    return entries
+
+
+def repair_tail(path):
+    # Drop a trailing partial line so new entries start on a fresh line
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data.endswith(b'\n'):
+            return
+        f.truncate(data.rfind(b'\n') + 1)
+
+
+class JsonlResultWriter:
+    def __init__(self, path, fsync_every=16):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.unsynced = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        repair_tail(path)
+        self.done_ids = set(entry['id'] for entry in read_jsonl(path))
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.done_ids)
+
+    def __contains__(self, id):
+        return id in self.done_ids
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.done_ids.add(entry['id'])
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def json_to_jsonl(json_path, jsonl_path):
+    with open(json_path, 'r', encoding='utf-8') as f:
+        json_data = json.load(f) if os.path.getsize(json_path) > 0 else []
+    with JsonlResultWriter(jsonl_path) as writer:
+        for entry in json_data:
+            if entry['id'] not in writer:
+                writer.append(entry)
+    return len(json_data)
+
+
+def jsonl_to_json(jsonl_path, json_path):
+    # Keep the last entry of every id and write them in id order, in the original result format
+    entries = {entry['id']: entry for entry in read_jsonl(jsonl_path)}
+    json_data = [entries[id] for id in sorted(entries)]
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(json_data, f, ensure_ascii=False, indent=4)
+    return len(json_data)
+
+
+def merge_shards(json_path, count, total=None, partial=True):
+    # Merge result/<job>.shard<i>of<N>.jsonl into result/<job>.json in id order; returns the
+    # number of merged segments and the missing ids (with partial=False nothing is written then)
+    result_name = os.path.splitext(json_path)[0]
+    entries = {}
+    for index in range(count):
+        for entry in read_jsonl(shard_output(result_name, index, count)):
+            entries[entry['id']] = entry
+    if total is None:
+        total = max(entries) + 1 if entries else 0
+    missing = [id for id in range(total) if id not in entries]
+    if missing and not partial:
+        return len(entries), missing
+    json_data = [entries[id] for id in sorted(entries)]
+    if os.path.dirname(json_path):
+        os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(json_data, f, ensure_ascii=False, indent=4)
+    return len(json_data), missing
+
+
+def main():
+    parser = argparse.ArgumentParser('Convert and merge TEaR result files')
+    commands = parser.add_subparsers(dest='command', required=True)
+    to_json = commands.add_parser('to-json', help='JSONL -> JSON')
+    to_jsonl = commands.add_parser('to-jsonl', help='JSON -> JSONL')
+    for command in (to_json, to_jsonl):
+        command.add_argument('input', type=str, help='input result file')
+        command.add_argument('output', type=str, nargs='?', default='', help='output result file (default: input with the other extension)')
+    merge = commands.add_parser('merge', help='merge the shards of a job into its JSON result')
+    merge.add_argument('output', type=str, help='result/<job>.json; shards are read from result/<job>.shard<i>of<N>.jsonl')
+    merge.add_argument('shards', type=int, help='number of shards N')
+    merge.add_argument('--total', type=int, default=None, help='number of segments of the job (default: highest id + 1)')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        n, missing = merge_shards(args.output, args.shards, args.total)
+        print(f"Merged {n} segments from {args.shards} shards to {args.output}")
+        if missing:
+            print(f"Missing {len(missing)} ids: {missing}")
+            sys.exit(1)
+        return
+
+    if args.command == 'to-json':
+        output = args.output or os.path.splitext(args.input)[0] + '.json'
+        n = jsonl_to_json(args.input, output)
+    else:
+        output = args.output or os.path.splitext(args.input)[0] + '.jsonl'
+        n = json_to_jsonl(args.input, output)
+    print(f"Converted {n} segments to {output}")
+
+
+if __name__ == '__main__':
+    main()
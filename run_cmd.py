@@ -1,7 +1,14 @@
+import os
+import sys
 import json
 import argparse
+import socketserver
+import threading
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv, find_dotenv
-from ter_lib import generate_ans, TEaR
+from ter_lib import generate_ans, TEaR, run_tear, set_scheduler
+from scheduler import RequestScheduler
 
 
 def read_json(path):
@@ -9,6 +16,137 @@ def read_json(path):
         return json.load(f)
 
 
+class TEaRWorker:
+    # Long-lived translation worker: TEaR modules (templates, examples, parsers) and LLM clients
+    # are built once per (lang, model, module, strategy) and shared by all requests
+    def __init__(self, args):
+        self.args = args
+        self.lan_pairs = {list(obj.keys())[0]: list(obj.values())[0] for obj in read_json('language_pair.json')}
+        self.modules = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=args.workers)
+        # Bound the requests read ahead of the ones being processed
+        self.slots = threading.BoundedSemaphore(4 * args.workers)
+
+    def get_module(self, lang, model, module, strategy):
+        key = (lang, model, module, strategy)
+        with self.lock:
+            if key not in self.modules:
+                self.modules[key] = TEaR(lang_pair=lang, model=model, module=module, strategy=strategy)
+            return self.modules[key]
+
+    def handle(self, request):
+        args = self.args
+        lang = request.get('lang', args.lang)
+        model = request.get('model', args.model)
+        translate_strategy = request.get('translate_strategy', args.translate_strategy)
+        estimate_strategy = request.get('estimate_strategy', args.estimate_strategy)
+        refine_strategy = request.get('refine_strategy', args.refine_strategy)
+        if lang in self.lan_pairs:
+            src_lan, tgt_lan = self.lan_pairs[lang][0], self.lan_pairs[lang][1]
+        else:
+            src_lan, tgt_lan = args.src_lang, args.tgt_lang
+            translate_strategy, refine_strategy = 'zero-shot', 'alpha'
+        src_lan = request.get('src_lang', src_lan)
+        tgt_lan = request.get('tgt_lang', tgt_lan)
+
+        T = self.get_module(lang, model, 'translate', translate_strategy)
+        E = self.get_module(lang, model, 'estimate', estimate_strategy)
+        R = self.get_module(lang, model, 'refine', refine_strategy)
+        hyp, cor, nc, mqm_info = run_tear(T, E, R, src_lan, tgt_lan, request['src'])
+        return {"id": request.get('id'), "lang": lang, "model": model, "src": request['src'], "hyp": hyp,
+                "cor": cor, "need correction": nc, "mqm_info": mqm_info}
+
+    def submit(self, line, write):
+        # Process one JSONL request in the pool; write(line) gets the JSONL result when it is done
+        line = line.strip()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or 'src' not in request:
+                raise ValueError("a JSON object with a \"src\" field is expected")
+        except ValueError as e:
+            write(json.dumps({"id": None, "error": f"bad request: {e}"}, ensure_ascii=False))
+            return
+
+        def process():
+            try:
+                result = self.handle(request)
+            except Exception as e:
+                result = {"id": request.get('id'), "error": f"{type(e).__name__}: {e}"}
+            finally:
+                self.slots.release()
+            write(json.dumps(result, ensure_ascii=False))
+
+        self.slots.acquire()
+        self.pool.submit(process)
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+def locked_writer(stream):
+    lock = threading.Lock()
+
+    def write(line):
+        with lock:
+            stream.write(line + '\n')
+            stream.flush()
+    return write
+
+
+def serve_stdin(worker):
+    # Results go to the real stdout; everything else printed while serving goes to stderr
+    write = locked_writer(sys.stdout)
+    with redirect_stdout(sys.stderr):
+        for line in sys.stdin:
+            worker.submit(line, write)
+        worker.close()
+
+
+def serve_socket(worker, path):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            stream = self.wfile
+            lock = threading.Lock()
+            pending = threading.Semaphore(0)
+            count = 0
+
+            def write(line):
+                # Released even if the client is gone, so the handler below never waits forever
+                try:
+                    with lock:
+                        stream.write((line + '\n').encode('utf-8'))
+                        stream.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    pending.release()
+
+            for raw in self.rfile:
+                line = raw.decode('utf-8')
+                if line.strip():
+                    count += 1
+                    worker.submit(line, write)
+            # Keep the connection open until all its results are written
+            for _ in range(count):
+                pending.acquire()
+
+    if os.path.exists(path):
+        os.remove(path)
+    with redirect_stdout(sys.stderr):
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+            print(f"TEaR worker listening on {path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                worker.close()
+                os.remove(path)
+
+
 def main():
     # Argument parsing
     parser = argparse.ArgumentParser('Command-line script to use TER')
@@ -19,8 +157,21 @@ def main():
     parser.add_argument('-ts', '--translate_strategy', type=str, default='few-shot', help='which prompting strategy is used in translating')
     parser.add_argument('-es', '--estimate_strategy', type=str, default='few-shot', help='which prompting strategy is used in estimating')
     parser.add_argument('-rs', '--refine_strategy', type=str, default='beta', help='which prompting strategy is used in refining')
+    parser.add_argument('--serve', action='store_true', help='read JSONL requests from stdin and write JSONL results to stdout')
+    parser.add_argument('--socket', type=str, default='', help='serve JSONL requests on this Unix socket path')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='requests processed concurrently when serving')
     args = parser.parse_args()
 
+    if args.serve or args.socket:
+        load_dotenv(find_dotenv())
+        set_scheduler(RequestScheduler())
+        worker = TEaRWorker(args)
+        if args.socket:
+            serve_socket(worker, args.socket)
+        else:
+            serve_stdin(worker)
+        return
+
     src_lan = args.src_lang
     tgt_lan = args.tgt_lang
 
@@ -46,7 +197,7 @@ def main():
     R = TEaR(lang_pair=args.lang, model=args.model, module='refine', strategy=args.refine_strategy)
 
     # Load examples and set parser
-    examples = T.load_examples()
+    examples = T.examples_for(src_text)
     json_parser, json_output_instructions = T.set_parser()
 
     # Translate
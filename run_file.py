@@ -2,7 +2,15 @@ import json
 import os
 import argparse
 from dotenv import load_dotenv, find_dotenv
-from ter_lib import generate_ans, TEaR
+from ter_lib import TEaR, run_tear_batch, ordered_map, set_response_cache, set_scheduler, set_metrics, set_mqm_policy, set_hedge_policy, get_provider
+from metrics import MetricsRecorder
+from scheduler import RequestScheduler
+from llm_cache import ResponseCache
+from result_store import JsonlResultWriter, json_to_jsonl, jsonl_to_json, merge_shards
+from shot_index import ShotIndex
+from mqm import MQMPolicy
+from hedge import HedgePolicy
+from shard import parse_shard, shard_ids, shard_output, claim_shard
 # Load environment variables
 load_dotenv(find_dotenv())
 
@@ -11,13 +19,7 @@ def read_json(path):
     with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def save_json(data, path):
-    if os.path.getsize(path) > 0:
-        with open(path, "r", encoding="utf-8") as jsonfile:
-            json_data = json.load(jsonfile)
-    else:
-        json_data = []
-
+def save_result(data, writer):
     json_entry = {
         "id": data['id'],
         "src": data['src'],
@@ -28,12 +30,9 @@ def save_json(data, path):
         "mqm_info": data['mqm_info']
     }
 
-    json_data.append(json_entry)
-
-    with open(path, "w", encoding="utf-8") as jsonfile:
-        json.dump(json_data, jsonfile, ensure_ascii=False, indent=4)
+    writer.append(json_entry)
 
-    print(f"Successfully appended data to file {path}")
+    print(f"Successfully appended data to file {writer.path}")
     print(f"----------------(╹ڡ╹ )-----------End---------o(*￣▽￣*)ブ-----------------")
     print(f"\n")
     return
@@ -44,6 +43,149 @@ def read_txt(path):
         lines = [line.strip() for line in lines]
     return lines
 
+def find_lang_pair(lang):
+    # Check if lang exists in the JSON file using assert; returns languages and src/ref paths
+    lan_pairs = read_json('language_pair.json')
+    found_pair = None
+    for obj in lan_pairs:
+        if list(obj.keys())[0] == lang:
+            found_pair = obj
+            break
+    assert found_pair is not None, f"Not support {lang}"
+
+    src_lan = found_pair[lang][0]
+    tgt_lan = found_pair[lang][1]
+    src_path = f"dataset/mt/baseline/{found_pair[lang][2]}{found_pair[lang][3]}/rand_200_test.{lang}.{found_pair[lang][2]}"
+    ref_path = f"dataset/mt/baseline/{found_pair[lang][2]}{found_pair[lang][3]}/rand_200_test.{lang}.{found_pair[lang][3]}"
+    return src_lan, tgt_lan, src_path, ref_path
+
+def job_name(model, lang, translate_strategy, estimate_strategy, refine_strategy, options=''):
+    return f"result/{model}_{lang}_{translate_strategy}_{estimate_strategy}_{refine_strategy}{options}"
+
+def options_tag(refine_threshold=0, compact_mqm=False, retrieve_shots=0, shot_tokens=250):
+    # Name suffix of the options that change prompts, mqm_info or "need correction", e.g. _rt5_compact_shots4x250,
+    # so such runs never resume from or overwrite the results of another setting; empty for the defaults
+    tag = ''
+    if refine_threshold:
+        tag += f"_rt{refine_threshold}"
+    if compact_mqm:
+        tag += "_compact"
+    if retrieve_shots:
+        tag += f"_shots{retrieve_shots}x{shot_tokens}"
+    return tag
+
+def model_tag(model, translate_model='', estimate_model='', refine_model='', escalate_model=''):
+    # The model of a job, or its per-module models when they differ, e.g. gpt-4o+gpt-4o-mini~gpt-4o+gpt-4o
+    models = [translate_model or model, (estimate_model or model) + (f"~{escalate_model}" if escalate_model else ''), refine_model or model]
+    return model if models == [model] * 3 else '+'.join(models)
+
+def open_results(result_name, fsync_every=16):
+    # The JSONL result writer of a job; resumes from an older JSON result if there is one
+    output, json_output = f"{result_name}.jsonl", f"{result_name}.json"
+    if not os.path.isfile(output) and os.path.isfile(json_output):
+        json_to_jsonl(json_output, output)
+    return JsonlResultWriter(output, fsync_every=fsync_every)
+
+def pipeline_job_name(args, lang, model, translate_strategy, estimate_strategy, refine_strategy):
+    # Result name of a job, with the module models and options of add_pipeline_args
+    tag = model_tag(model, args.translate_model, args.estimate_model, args.refine_model, args.escalate_model)
+    options = options_tag(args.refine_threshold, args.compact_mqm, args.retrieve_shots, args.shot_tokens)
+    return job_name(tag, lang, translate_strategy, estimate_strategy, refine_strategy, options)
+
+def add_pipeline_args(parser, batch=False):
+    # Flags shared by run_file.py, run_matrix.py and batch_api.py, read by setup_pipeline. batch=True
+    # leaves out the cascade and hedging, which need synchronous requests
+    parser.add_argument('-tm', '--translate_model', type=str, default='', help='model of the translate module (default: -m)')
+    parser.add_argument('-em', '--estimate_model', type=str, default='', help='model of the estimate module (default: -m)')
+    parser.add_argument('-rm', '--refine_model', type=str, default='', help='model of the refine module (default: -m)')
+    parser.add_argument('--refine_threshold', type=int, default=0, help='refine only when the MQM score (critical 10, major 5, minor 1) reaches this; 0 = any error')
+    parser.add_argument('--compact_mqm', action='store_true', help='store and send to refine a compact form of the MQM annotations')
+    parser.add_argument('--retrieve_shots', type=int, default=0, help='use the K most similar examples of the pool (shot_index.py) instead of the whole shots file; 0 = off')
+    parser.add_argument('--shot_tokens', type=int, default=250, help='token budget of the retrieved examples')
+    parser.add_argument('--rpm', type=int, default=None, help="requests/min allowed for each provider of the run's models (default: scheduler.PROVIDER_LIMITS)")
+    parser.add_argument('--tpm', type=int, default=None, help="tokens/min allowed for each provider of the run's models (default: scheduler.PROVIDER_LIMITS)")
+    parser.add_argument('--max_retries', type=int, default=8, help='retries of a rate-limited or failed request')
+    parser.add_argument('--cache', type=str, default='', help='SQLite file caching LLM answers, e.g. cache/responses.sqlite')
+    parser.add_argument('--cache_size', type=int, default=200000, help='maximum number of cached answers')
+    parser.add_argument('--metrics', type=str, default='', help='JSONL file for per-call metrics, e.g. result/metrics.jsonl')
+    if batch:
+        parser.set_defaults(escalate_model='', escalate_on=[], hedge=0, hedge_model='', hedge_delay=10)
+        return
+    parser.add_argument('--escalate_model', type=str, default='', help='re-estimate on this model when the estimate model finds --escalate_on errors or its answer does not parse')
+    parser.add_argument('--escalate_on', nargs='+', default=['critical', 'major'], help='error severities that escalate an estimate')
+    parser.add_argument('--hedge', type=float, default=0, help='duplicate requests slower than this latency quantile of their provider, e.g. 0.95; 0 = off')
+    parser.add_argument('--hedge_model', type=str, default='', help='model of the duplicate requests (default: the same model)')
+    parser.add_argument('--hedge_delay', type=float, default=10, help='hedge delay in seconds until enough latencies are known')
+
+class Pipeline:
+    # What setup_pipeline installed, and the TEaR modules of a job under the run's options
+    def __init__(self, args, metrics, hedge, cache):
+        self.args = args
+        self.metrics = metrics
+        self.hedge = hedge
+        self.cache = cache
+        self.indexes = {}
+
+    def modules(self, lang, model, translate_strategy, estimate_strategy, refine_strategy):
+        args = self.args
+        T = TEaR(lang_pair=lang, model=args.translate_model or model, module='translate', strategy=translate_strategy)
+        E = TEaR(lang_pair=lang, model=args.estimate_model or model, module='estimate', strategy=estimate_strategy)
+        R = TEaR(lang_pair=lang, model=args.refine_model or model, module='refine', strategy=refine_strategy)
+        if args.escalate_model:
+            E.set_cascade(args.escalate_model, args.escalate_on)
+        if args.retrieve_shots:
+            # One index per language pair, shared by its jobs
+            if lang not in self.indexes:
+                self.indexes[lang] = ShotIndex.for_lang_pair(lang)
+            T.set_retriever(self.indexes[lang], args.retrieve_shots, args.shot_tokens)
+        return T, E, R
+
+    def close(self):
+        if self.hedge is not None:
+            print(f"Hedged requests: {self.hedge.summary()}")
+        if self.cache is not None:
+            print(f"Response cache: {self.cache.stats()}")
+            self.cache.close()
+        self.metrics.print_summary()
+        self.metrics.close()
+
+def setup_pipeline(args, models):
+    # Installs the scheduler, metrics, hedge policy, MQM policy and response cache of add_pipeline_args
+    # for a run of the -m models; close the returned Pipeline at the end of the run
+
+    # Keep requests within the providers' rate limits and retry 429s with backoff; --rpm/--tpm
+    # apply to every provider a module, the escalation or the hedge model uses
+    models = list(models) + [args.translate_model, args.estimate_model, args.refine_model, args.escalate_model, args.hedge_model]
+    providers = {get_provider(model) for model in models if model}
+    limits = {key: value for key, value in [('rpm', args.rpm), ('tpm', args.tpm)] if value is not None}
+    scheduler = RequestScheduler(max_retries=args.max_retries)
+    for provider in providers:
+        scheduler.limits[provider] = dict(scheduler.limits.get(provider, {}), **limits)
+    set_scheduler(scheduler)
+
+    # Per-call latency/token/cost metrics, summarized at the end of the run
+    metrics = MetricsRecorder(args.metrics or None)
+    set_metrics(metrics)
+
+    # Duplicate the requests that are slower than most requests of their provider
+    hedge = None
+    if args.hedge:
+        hedge = HedgePolicy(fallback=args.hedge_model or None, quantile=args.hedge, initial_delay=args.hedge_delay)
+    set_hedge_policy(hedge)
+
+    # Severity-weighted refine decision and compact MQM annotations
+    policy = None
+    if args.refine_threshold or args.compact_mqm:
+        policy = MQMPolicy(threshold=args.refine_threshold or 1, compact=args.compact_mqm)
+    set_mqm_policy(policy)
+
+    # Reuse identical translate/estimate/refine calls from earlier runs
+    cache = None
+    if args.cache:
+        cache = ResponseCache(args.cache, max_entries=args.cache_size)
+    set_response_cache(cache)
+    return Pipeline(args, metrics, hedge, cache)
+
 def main():
     # Argument parsing
     parser = argparse.ArgumentParser('Command-line script to use TEaR')
@@ -55,41 +197,18 @@ def main():
     parser.add_argument('--ref', type=str, default='', help='reference path')
     parser.add_argument('--src', type=str, default='', help='source text path')
     parser.add_argument('--output', type=str, default='', help='hypothesis text path')
+    parser.add_argument('--fsync_every', type=int, default=16, help='fsync the result file after this many segments')
+    parser.add_argument('-eb', '--estimate_batch', type=int, default=1, help='number of segments estimated with one request')
+    parser.add_argument('--shard', type=str, default='', help='i/N: run only the segments with id % N == i; N: take over any unfinished shard')
+    parser.add_argument('--lease_ttl', type=float, default=120, help='seconds without heartbeat after which a shard lease can be taken over')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='number of segments translated concurrently')
+    add_pipeline_args(parser)
     args = parser.parse_args()
 
-    # Check if args.lang exists in the JSON file using assert
-    lan_pairs = read_json('language_pair.json')
-    found_pair = None
-    for obj in lan_pairs:
-        if list(obj.keys())[0] == args.lang:
-            found_pair = obj
-            break
-    assert found_pair is not None, f"Not support {args.lang}"
-
-    src_lan = found_pair[args.lang][0]
-    tgt_lan = found_pair[args.lang][1]
-    args.src = f"dataset/mt/baseline/{found_pair[args.lang][2]}{found_pair[args.lang][3]}/rand_200_test.{args.lang}.{found_pair[args.lang][2]}"
-    args.ref = f"dataset/mt/baseline/{found_pair[args.lang][2]}{found_pair[args.lang][3]}/rand_200_test.{args.lang}.{found_pair[args.lang][3]}"
-    args.output = f"result/{args.model}_{args.lang}_{args.translate_strategy}_{args.estimate_strategy}_{args.refine_strategy}.json"
-
-    if os.path.isfile(args.output):
-        if os.path.getsize(args.output) > 0:
-            with open(args.output, "r", encoding="utf-8") as jsonfile:
-                json_data = json.load(jsonfile)
-        else:
-            json_data = []
-    else:
-        os.makedirs(os.path.dirname(args.output), exist_ok=True)
-        with open(args.output, "w", encoding="utf-8") as jsonfile:
-            json_data = []
-
-    print(f"Have translated {len(json_data)} segments!")
-
-
-    # Initialize TER instances
-    T = TEaR(lang_pair=args.lang, model=args.model, module='translate', strategy=args.translate_strategy)
-    E = TEaR(lang_pair=args.lang, model=args.model, module='estimate', strategy=args.estimate_strategy)
-    R = TEaR(lang_pair=args.lang, model=args.model, module='refine', strategy=args.refine_strategy)
+    src_lan, tgt_lan, args.src, args.ref = find_lang_pair(args.lang)
+    result_name = pipeline_job_name(args, args.lang, args.model, args.translate_strategy, args.estimate_strategy, args.refine_strategy)
+    args.output = f"{result_name}.jsonl"
+    json_output = f"{result_name}.json"
 
     # Read source and reference texts
     srcs = read_txt(args.src)
@@ -97,53 +216,75 @@ def main():
     print(f"Loaded {len(srcs)} source segments!")
     assert len(srcs) == len(refs), "please check src and ref files"
 
-    for index, line in enumerate(srcs):
-        write_in_json = {}
-
-        if os.path.getsize(args.output) > 0:
-            with open(args.output, "r", encoding="utf-8") as jsonfile:
-                json_data = json.load(jsonfile)
-        else:
-            json_data = []
-
-        # Check if index already exists in JSON data
-        existing_ids = [obj["id"] for obj in json_data]
-        if index in existing_ids:
-            continue
-
-        print(f"----------------(╹ڡ╹ )---------Begin {index}-------o(*￣▽￣*)ブ----------------")
-        # Load examples and set parser
-        examples = T.load_examples()
-        json_parser, json_output_instructions = T.set_parser()
-
-        # Translate
-        T_messages = T.fill_prompt(src_lan, tgt_lan, line, json_output_instructions, examples)
-        hyp = generate_ans(args.model, 'translate', T_messages, json_parser)
-
-        # Estimate
-        json_parser, json_output_instructions = E.set_parser()
-        E_messages = E.fill_prompt(src_lan, tgt_lan, line, json_output_instructions, examples, hyp)
-        mqm_info, nc = generate_ans(args.model, 'estimate', E_messages, json_parser)
-
-        # Refine if necessary
-        if nc == 1:
-            json_parser, json_output_instructions = R.set_parser()
-            R_messages = R.fill_prompt(src_lan, tgt_lan, line, json_output_instructions, examples, hyp, mqm_info)
-            cor = generate_ans(args.model, 'refine', R_messages, json_parser)
-        elif nc == 0:
-            cor = hyp
-
-        # Prepare data for writing to JSON
-        write_in_json['id'] = index
-        write_in_json['src'] = srcs[index]
-        write_in_json['ref'] = refs[index]
-        write_in_json['hyp'] = hyp
-        write_in_json['cor'] = cor
-        write_in_json['need correction'] = nc
-        write_in_json['mqm_info'] = mqm_info
-
-        # Save to JSON file
-        save_json(write_in_json, args.output)
+    # With --shard, only the segments of one leased shard are run, into the shard's own file
+    ids = range(len(srcs))
+    lease = None
+    if args.shard:
+        shard_index, shard_count = parse_shard(args.shard)
+        shard_index, lease = claim_shard(result_name, shard_index, shard_count, len(srcs), args.lease_ttl)
+        if lease is None:
+            print(f"No shard of {shard_count} left to run")
+            return
+        print(f"Running shard {shard_index}/{shard_count}")
+        ids = shard_ids(len(srcs), shard_index, shard_count)
+        args.output = shard_output(result_name, shard_index, shard_count)
+        writer = JsonlResultWriter(args.output, fsync_every=args.fsync_every)
+    # Results are appended to a JSONL file
+    else:
+        writer = open_results(result_name, args.fsync_every)
+
+    print(f"Have translated {len(writer)} segments!")
+
+    pipeline = setup_pipeline(args, [args.model])
+    metrics = pipeline.metrics
+    T, E, R = pipeline.modules(args.lang, args.model, args.translate_strategy, args.estimate_strategy, args.refine_strategy)
+
+    pending = [index for index in ids if index not in writer]
+    chunks = [pending[i:i + args.estimate_batch] for i in range(0, len(pending), args.estimate_batch)]
+
+    def process(chunk):
+        for index in chunk:
+            print(f"----------------(╹ڡ╹ )---------Begin {index}-------o(*￣▽￣*)ブ----------------")
+        results = run_tear_batch(T, E, R, src_lan, tgt_lan, [srcs[index] for index in chunk])
+        return [(index,) + result for index, result in zip(chunk, results)]
+
+    # Segments run concurrently, but results are saved in source order
+    try:
+        for rows in ordered_map(process, chunks, workers=args.workers):
+            if lease is not None and lease.lost:
+                raise RuntimeError(f"lost the lease of {args.output} to another worker")
+            for index, hyp, cor, nc, mqm_info in rows:
+                write_in_json = {}
+
+                # Prepare data for writing to JSONL
+                write_in_json['id'] = index
+                write_in_json['src'] = srcs[index]
+                write_in_json['ref'] = refs[index]
+                write_in_json['hyp'] = hyp
+                write_in_json['cor'] = cor
+                write_in_json['need correction'] = nc
+                write_in_json['mqm_info'] = mqm_info
+
+                # Save to JSONL file
+                save_result(write_in_json, writer)
+                metrics.record_segment(index, nc)
+    finally:
+        writer.close()
+        if lease is not None:
+            lease.release()
+        pipeline.close()
+
+    # Export the finished job in the JSON result format
+    if lease is not None:
+        if all(index in writer for index in ids):
+            n, missing = merge_shards(json_output, shard_count, len(srcs), partial=False)
+            if missing:
+                print(f"Shard {shard_index}/{shard_count} done, {len(missing)} segments of other shards still missing")
+            else:
+                print(f"All {len(srcs)} segments of {shard_count} shards merged to {json_output}")
+    elif len(writer) == len(srcs):
+        jsonl_to_json(args.output, json_output)
+        print(f"All {len(srcs)} segments saved to {json_output}")
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,199 @@
+import os
+import time
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv, find_dotenv
+from ter_lib import run_tear_batch
+from result_store import jsonl_to_json
+from run_file import read_json, read_txt, find_lang_pair, open_results, add_pipeline_args, setup_pipeline, pipeline_job_name
+# Load environment variables
+load_dotenv(find_dotenv())
+
+# Runs a matrix of run_file.py jobs (language pair x model x strategies) in one process. The
+# segments of all jobs share one worker pool and one RequestScheduler, so the provider rate
+# limits hold for the whole sweep. With --order fair the next segment comes from the job with
+# the fewest segments in flight (then the least progress); with --order priority, jobs with a
+# higher priority go first and fair-share only breaks ties. Every job writes and resumes its
+# own result/<job>.jsonl exactly like run_file.py.
+
+
+class Job:
+    def __init__(self, args, lang, model, translate_strategy, estimate_strategy, refine_strategy, priority=0):
+        # args: the add_pipeline_args options of the sweep, part of the result name
+        self.lang = lang
+        self.model = model
+        self.strategies = (translate_strategy, estimate_strategy, refine_strategy)
+        self.priority = priority
+        self.result_name = pipeline_job_name(args, lang, model, translate_strategy, estimate_strategy, refine_strategy)
+        self.name = self.result_name.split('/', 1)[1]
+        self.src_lan, self.tgt_lan, src_path, ref_path = find_lang_pair(lang)
+        self.srcs = read_txt(src_path)
+        self.refs = read_txt(ref_path)
+        assert len(self.srcs) == len(self.refs), f"{self.name}: please check src and ref files"
+        self.T = self.E = self.R = None
+        self.writer = None
+        self.resumed = 0
+        self.pending = []
+        self.in_flight = 0
+        self.done = 0
+        self.error = None
+        self.start = None
+        self.end = None
+
+    def open(self, pipeline, fsync_every, batch_size):
+        self.T, self.E, self.R = pipeline.modules(self.lang, self.model, *self.strategies)
+        self.writer = open_results(self.result_name, fsync_every)
+        ids = [index for index in range(len(self.srcs)) if index not in self.writer]
+        self.pending = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+        self.resumed = len(self.writer)
+
+    def process(self, chunk):
+        results = run_tear_batch(self.T, self.E, self.R, self.src_lan, self.tgt_lan, [self.srcs[index] for index in chunk])
+        return [(index,) + result for index, result in zip(chunk, results)]
+
+    def save(self, rows, metrics):
+        for index, hyp, cor, nc, mqm_info in rows:
+            self.writer.append({
+                "id": index,
+                "src": self.srcs[index],
+                "ref": self.refs[index],
+                "hyp": hyp,
+                "cor": cor,
+                "need correction": nc,
+                "mqm_info": mqm_info
+            })
+            metrics.record_segment(index, nc, job=self.name)
+        self.done += len(rows)
+
+    @property
+    def finished(self):
+        return not self.pending and self.in_flight == 0
+
+    def throughput(self):
+        if self.start is None:
+            return 0.0
+        elapsed = (self.end or time.time()) - self.start
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def status(self):
+        total = len(self.srcs) - self.resumed
+        state = 'failed' if self.error else 'done' if self.finished else 'running' if self.start else 'waiting'
+        return f"{self.name}: {self.done}/{total} segments, {self.throughput():.2f} seg/s, {state}"
+
+
+def load_jobs(args):
+    # Jobs from a JSON list of {"lang", "model", "ts", "es", "rs", "priority"}, or the cross product of the flags
+    if args.jobs:
+        return [Job(args, job['lang'], job['model'], job.get('ts', 'few-shot'), job.get('es', 'few-shot'), job.get('rs', 'beta'),
+                    job.get('priority', 0)) for job in read_json(args.jobs)]
+    langs = args.lang
+    if langs == ['all']:
+        langs = [list(obj.keys())[0] for obj in read_json('language_pair.json')]
+        missing = [lang for lang in langs if not os.path.isfile(find_lang_pair(lang)[2])]
+        if missing:
+            print(f"Skipping language pairs without test data: {', '.join(missing)}")
+        langs = [lang for lang in langs if lang not in missing]
+    matrix = itertools.product(langs, args.model, args.translate_strategy, args.estimate_strategy, args.refine_strategy)
+    return [Job(args, *combination) for combination in matrix]
+
+
+def next_job(jobs, order):
+    # The job whose next chunk is submitted, or None if no job has work left
+    ready = [job for job in jobs if job.pending and not job.error]
+    if not ready:
+        return None
+    fair = lambda job: (job.in_flight, job.done / len(job.srcs))
+    if order == 'priority':
+        return min(ready, key=lambda job: (-job.priority,) + fair(job))
+    return min(ready, key=fair)
+
+
+def print_progress(jobs, start):
+    done = sum(job.done for job in jobs)
+    elapsed = time.time() - start
+    print(f"==== {done} segments in {elapsed:.1f}s ({done / elapsed if elapsed > 0 else 0.0:.2f} seg/s) ====")
+    for job in jobs:
+        print(f"    {job.status()}")
+
+
+def main():
+    parser = argparse.ArgumentParser('Run a matrix of TEaR jobs over one worker pool')
+    parser.add_argument('-l', '--lang', nargs='+', default=['zh-en'], help="language pairs, or 'all' for language_pair.json")
+    parser.add_argument('-m', '--model', nargs='+', default=['gpt-3.5-turbo'], help='the model endpoints')
+    parser.add_argument('-ts', '--translate_strategy', nargs='+', default=['few-shot'], help='prompting strategies used in translating')
+    parser.add_argument('-es', '--estimate_strategy', nargs='+', default=['few-shot'], help='prompting strategies used in estimating')
+    parser.add_argument('-rs', '--refine_strategy', nargs='+', default=['beta'], help='prompting strategies used in refining')
+    parser.add_argument('--jobs', type=str, default='', help='JSON list of jobs {"lang", "model", "ts", "es", "rs", "priority"} instead of the flags above')
+    parser.add_argument('--order', choices=['fair', 'priority'], default='fair', help='which job gets the next free worker')
+    parser.add_argument('-w', '--workers', type=int, default=8, help='number of segments translated concurrently, over all jobs')
+    parser.add_argument('-eb', '--estimate_batch', type=int, default=1, help='segments per estimate request')
+    parser.add_argument('--fsync_every', type=int, default=16, help='fsync each result file every N segments')
+    parser.add_argument('--report_every', type=float, default=30, help='seconds between progress reports')
+    add_pipeline_args(parser)
+    args = parser.parse_args()
+
+    jobs = load_jobs(args)
+    assert len(set(job.name for job in jobs)) == len(jobs), "the same job is listed twice"
+    print(f"Loaded {len(jobs)} jobs, {sum(len(job.srcs) for job in jobs)} segments")
+    # One scheduler for all jobs: jobs on the same provider share its rate limits
+    pipeline = setup_pipeline(args, [job.model for job in jobs])
+    metrics = pipeline.metrics
+
+    start = time.time()
+    last_report = start
+    running = {}
+    try:
+        for job in jobs:
+            job.open(pipeline, args.fsync_every, args.estimate_batch)
+            print(f"{job.name}: have translated {job.resumed} of {len(job.srcs)} segments")
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            while True:
+                # Keep every worker busy, picking the job of each chunk by the ordering policy
+                while len(running) < args.workers:
+                    job = next_job(jobs, args.order)
+                    if job is None:
+                        break
+                    chunk = job.pending.pop(0)
+                    job.in_flight += 1
+                    if job.start is None:
+                        job.start = time.time()
+                    running[pool.submit(job.process, chunk)] = job
+                if not running:
+                    break
+
+                finished, _ = wait(running, timeout=args.report_every, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    job.in_flight -= 1
+                    try:
+                        job.save(future.result(), metrics)
+                    except Exception as e:
+                        # A failing job stops taking workers; the others go on
+                        print(f"{job.name}: failed with {type(e).__name__}: {e}")
+                        job.error = e
+                        job.pending = []
+                    if job.finished:
+                        job.end = time.time()
+                        print(job.status())
+                if time.time() - last_report >= args.report_every:
+                    print_progress(jobs, start)
+                    last_report = time.time()
+    finally:
+        for job in jobs:
+            if job.writer is not None:
+                job.writer.close()
+        pipeline.close()
+
+    # Export every finished job in the JSON result format
+    print_progress(jobs, start)
+    for job in jobs:
+        if len(job.writer) == len(job.srcs):
+            jsonl_to_json(job.writer.path, f"{job.result_name}.json")
+    failed = [job.name for job in jobs if job.error]
+    if failed:
+        raise SystemExit(f"{len(failed)} jobs failed: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
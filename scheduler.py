@@ -0,0 +1,222 @@
+import random
+import re
+import threading
+import time
+
+# Rate-limit aware request scheduling for generate_ans. Every provider in MODEL_ENDPOINTS gets
+# a requests/min and a tokens/min token bucket, a circuit breaker, and jittered exponential
+# backoff for rate-limit (429), timeout and server errors, so concurrent segments run at the
+# rate the provider allows instead of crashing the job on the first 429.
+
+# Default limits per provider, 0 means unlimited. Override them with RequestScheduler(limits=...)
+PROVIDER_LIMITS = {
+    'openai': {'rpm': 500, 'tpm': 200000},
+    'google': {'rpm': 60, 'tpm': 120000},
+    'zhipu': {'rpm': 300, 'tpm': 300000},
+    'fake': {'rpm': 0, 'tpm': 0},
+}
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = {'RateLimitError', 'APITimeoutError', 'APIConnectionError', 'InternalServerError',
+                    'TimeoutException', 'ConnectError', 'ReadTimeout', 'RemoteProtocolError',
+                    'ResourceExhausted', 'ServiceUnavailable', 'DeadlineExceeded'}
+
+
+def status_code(error):
+    for code in (getattr(error, 'status_code', None),
+                 getattr(getattr(error, 'response', None), 'status_code', None),
+                 getattr(error, 'code', None)):
+        if isinstance(code, int):
+            return code
+    return None
+
+
+def is_retryable(error):
+    return status_code(error) in RETRYABLE_STATUS or type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_after(error):
+    # Seconds asked for by a Retry-After header, if the error carries one
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+# CJK ideographs, kana and hangul take about a token per character, other text a token per ~3 characters
+WIDE_CHARS = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    # Rough count used for tokens/min accounting and prompt budgets before the real usage is known
+    wide = len(WIDE_CHARS.findall(text))
+    return wide + (len(text) - wide) // 3 + 1
+
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        # Block until `amount` is available and take it; returns the seconds waited
+        if self.rate <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self.refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return waited
+                delay = (amount - self.level) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def consume(self, amount):
+        # Charge usage found out after the call (may leave the bucket in debt)
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.refill()
+            self.level -= amount
+
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failures; while open, callers wait for the cooldown,
+    # then a single trial call decides whether it closes again
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = None  # thread making the trial call
+        self.lock = threading.Lock()
+
+    def wait(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                if self.opened_at is None:
+                    return waited
+                remaining = self.opened_at + self.cooldown - time.monotonic()
+                if remaining <= 0 and self.trial is None:
+                    self.trial = threading.get_ident()
+                    return waited
+                delay = max(remaining, 0.1)
+            time.sleep(delay)
+            waited += delay
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = None
+
+    def release_trial(self):
+        # The trial call of this thread ended without telling anything about the provider
+        # (a non-retryable error): stay open and let the next caller make the trial
+        with self.lock:
+            if self.trial == threading.get_ident():
+                self.trial = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self.trial is not None else 'open'
+
+
+class ProviderLimiter:
+    def __init__(self, rpm=0, tpm=0, threshold=5, cooldown=30.0):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.breaker = CircuitBreaker(threshold, cooldown)
+
+
+class RequestScheduler:
+    def __init__(self, limits=None, max_retries=8, base_delay=1.0, max_delay=60.0, failure_threshold=5, cooldown=30.0):
+        self.limits = dict(PROVIDER_LIMITS)
+        self.limits.update(limits or {})
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.limiters = {}
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'retries': 0, 'failures': 0}
+
+    def limiter(self, provider):
+        with self.lock:
+            if provider not in self.limiters:
+                limit = self.limits.get(provider, {})
+                self.limiters[provider] = ProviderLimiter(limit.get('rpm', 0), limit.get('tpm', 0), self.failure_threshold, self.cooldown)
+            return self.limiters[provider]
+
+    def backoff(self, attempt, error):
+        # Full jitter, but never shorter than what the provider asked for
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(delay, retry_after(error) or 0.0)
+
+    def call(self, provider, func, tokens=0, on_attempt=None):
+        # Run func() under the provider's limits; returns (result, info) where info has the
+        # time spent waiting for quota/backoff and the number of retries. on_attempt(True) is
+        # called when an attempt gets its slot, on_attempt(False) when it fails and backs off.
+        limiter = self.limiter(provider)
+        info = {'queue_wait': 0.0, 'retries': 0}
+        attempt = 0
+        while True:
+            info['queue_wait'] += limiter.breaker.wait()
+            info['queue_wait'] += limiter.requests.acquire(1)
+            info['queue_wait'] += limiter.tokens.acquire(tokens)
+            if on_attempt is not None:
+                on_attempt(True)
+            try:
+                result = func()
+            except Exception as e:
+                if not is_retryable(e):
+                    limiter.breaker.release_trial()
+                    raise
+                limiter.breaker.failure()
+                with self.lock:
+                    self.stats['failures'] += 1
+                if attempt >= self.max_retries:
+                    raise
+                if on_attempt is not None:
+                    on_attempt(False)
+                delay = self.backoff(attempt, e)
+                print(f"{provider} request failed ({type(e).__name__}: {status_code(e)}), retry {attempt + 1} in {delay:.1f}s")
+                time.sleep(delay)
+                info['queue_wait'] += delay
+                info['retries'] += 1
+                attempt += 1
+                with self.lock:
+                    self.stats['retries'] += 1
+                continue
+            limiter.breaker.success()
+            with self.lock:
+                self.stats['calls'] += 1
+            return result, info
+
+    def record_usage(self, provider, estimated, actual):
+        # Charge the difference between the real and the estimated token count
+        if actual and actual > estimated:
+            self.limiter(provider).tokens.consume(actual - estimated)
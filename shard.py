@@ -0,0 +1,110 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+# Sharding of a run_file.py job over several machines sharing the result/ directory.
+# Shard i of N owns the segments with id % N == i and writes result/<job>.shard<i>of<N>.jsonl.
+# A worker holds a lease file next to it and refreshes its heartbeat; a lease whose heartbeat is
+# older than the TTL belongs to a crashed worker and can be taken over, and the new owner
+# resumes from the ids already in the shard file. Merge the shards with
+# `python result_store.py merge result/<job>.json N`.
+
+
+def parse_shard(value):
+    # "i/N" -> (i, N); "N" -> (None, N), i.e. take any shard that is not finished or leased
+    if '/' in value:
+        index, count = (int(part) for part in value.split('/'))
+        assert 0 <= index < count, f"shard index must be in [0, {count})"
+        return index, count
+    return None, int(value)
+
+
+def shard_ids(total, index, count):
+    return [id for id in range(total) if id % count == index]
+
+
+def shard_output(result_name, index, count):
+    return f"{result_name}.shard{index}of{count}.jsonl"
+
+
+class ShardLease:
+    def __init__(self, path, ttl=120.0):
+        self.path = path
+        self.ttl = ttl
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.lost = False
+        self.stop = threading.Event()
+        self.thread = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self):
+        tmp = f"{self.path}.{self.owner.replace(':', '_')}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"owner": self.owner, "heartbeat": time.time()}, f)
+        os.replace(tmp, self.path)
+
+    def held_by_other(self):
+        lease = self.read()
+        return lease is not None and lease['owner'] != self.owner and time.time() - lease['heartbeat'] < self.ttl
+
+    def acquire(self, settle=1.0):
+        # Take the lease if it is free or stale. Two workers racing for the same stale lease both
+        # write it; after `settle` seconds only the last writer still finds its own name there.
+        if self.held_by_other():
+            return False
+        lease = self.read()
+        if lease is not None:
+            print(f"Taking over stale lease of {lease['owner']} on {self.path}")
+        self.write()
+        time.sleep(settle)
+        lease = self.read()
+        if lease is None or lease['owner'] != self.owner:
+            return False
+        self.thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.thread.start()
+        return True
+
+    def heartbeat(self):
+        while not self.stop.wait(self.ttl / 4):
+            lease = self.read()
+            if lease is not None and lease['owner'] != self.owner:
+                print(f"Lease {self.path} was taken over by {lease['owner']}")
+                self.lost = True
+                return
+            self.write()
+
+    def release(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        lease = self.read()
+        if lease is not None and lease['owner'] == self.owner:
+            os.remove(self.path)
+
+
+def claim_shard(result_name, index, count, total, ttl=120.0):
+    # Lease shard `index`, or with index None the first unfinished shard nobody holds.
+    # Returns (index, lease), or (None, None) if there is nothing left to take.
+    from result_store import read_jsonl
+    candidates = [index] if index is not None else range(count)
+    for i in candidates:
+        output = shard_output(result_name, i, count)
+        done = set(entry['id'] for entry in read_jsonl(output))
+        if index is None and done.issuperset(shard_ids(total, i, count)):
+            continue
+        lease = ShardLease(output + '.lease', ttl)
+        if lease.acquire():
+            return i, lease
+        print(f"Shard {i}/{count} is leased by another worker")
+    return None, None
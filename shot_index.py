@@ -0,0 +1,108 @@
+import math
+import os
+import re
+from collections import Counter
+from scheduler import estimate_tokens
+
+# Retrieval of few-shot examples: instead of every example of shots.{lang}.json, a prompt gets
+# the k pairs of the pool that are most similar to its source sentence (BM25 over character
+# n-grams, which works the same for spaced and unspaced scripts), within a token budget.
+# The pool of a language pair is dataset/mt/baseline/<pair>/test.*, without the sentences of
+# rand_200_test.* that run_file.py translates. An index is built in memory once per run: it takes
+# ~0.17s for the ~1.7k pairs of a pool, less than reading the postings back from a JSON file.
+
+POOL_DIR = 'dataset/mt/baseline'
+EXAMPLE_TEMPLATE = '''Source: {src_top} Target: {tgt_ans}'''
+
+
+def char_ngrams(text, n=3):
+    text = ' ' + re.sub(r'\s+', ' ', text.strip().lower()) + ' '
+    if len(text) <= n:
+        return [text]
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def pool_files(lang_pair):
+    # (source file, target file, files whose sentences are left out of the pool)
+    src, tgt = lang_pair.split('-')
+    folder = os.path.join(POOL_DIR, f"{src}{tgt}")
+    return (os.path.join(folder, f"test.{lang_pair}.{src}"), os.path.join(folder, f"test.{lang_pair}.{tgt}"),
+            [os.path.join(folder, f"rand_200_test.{lang_pair}.{src}")])
+
+
+def read_pool(lang_pair):
+    src_path, tgt_path, exclude_paths = pool_files(lang_pair)
+    with open(src_path, 'r', encoding='utf-8') as f:
+        srcs = [line.strip() for line in f]
+    with open(tgt_path, 'r', encoding='utf-8') as f:
+        tgts = [line.strip() for line in f]
+    assert len(srcs) == len(tgts), f"please check {src_path} and {tgt_path}"
+    excluded = set()
+    for path in exclude_paths:
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                excluded.update(line.strip() for line in f)
+    pairs = {}
+    for src, tgt in zip(srcs, tgts):
+        if src and tgt and src not in excluded:
+            pairs.setdefault(src, tgt)
+    return list(pairs.items())
+
+
+class ShotIndex:
+    def __init__(self, pairs, n=3, k1=1.5, b=0.75):
+        self.pairs = pairs
+        self.n = n
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.lengths = []
+        for doc, (src, tgt) in enumerate(pairs):
+            grams = Counter(char_ngrams(src, n))
+            self.lengths.append(sum(grams.values()))
+            for gram, tf in grams.items():
+                self.postings.setdefault(gram, []).append((doc, tf))
+        self.finalize()
+
+    def finalize(self):
+        avgdl = sum(self.lengths) / len(self.lengths) if self.lengths else 1.0
+        self.norms = [self.k1 * (1 - self.b + self.b * length / avgdl) for length in self.lengths]
+        total = len(self.pairs)
+        self.idf = {gram: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5)) for gram, docs in self.postings.items()}
+
+    @classmethod
+    def for_lang_pair(cls, lang_pair):
+        index = cls(read_pool(lang_pair))
+        print(f"Built few-shot index of {len(index.pairs)} {lang_pair} pairs")
+        return index
+
+    def search(self, text, k=4):
+        # [(score, doc)] of the k best matches of text
+        grams = set(char_ngrams(text, self.n))
+        scores = {}
+        for gram in grams:
+            idf = self.idf.get(gram)
+            if idf is None:
+                continue
+            for doc, tf in self.postings[gram]:
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.norms[doc])
+        best = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return [(score, doc) for doc, score in best]
+
+    def examples(self, text, k=4, max_tokens=250):
+        # The best k examples for text that fit in max_tokens, formatted like TEaR.read_examples
+        lines = []
+        used = 0
+        for score, doc in self.search(text, 4 * k):
+            src, tgt = self.pairs[doc]
+            if src == text.strip():
+                continue
+            line = EXAMPLE_TEMPLATE.format(src_top=src, tgt_ans=tgt)
+            tokens = estimate_tokens(line)
+            if used + tokens > max_tokens:
+                continue
+            lines.append(line)
+            used += tokens
+            if len(lines) == k:
+                break
+        return '\n'.join(lines)
@@ -1,68 +1,398 @@
 import json
 import os
-import openai
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.chat_models import ChatZhipuAI
-from langchain_openai.chat_models import ChatOpenAI
-from langchain.chains import ConversationChain
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
-from langchain.prompts import PromptTemplate, ChatPromptTemplate
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from dotenv import load_dotenv, find_dotenv
+from scheduler import estimate_tokens
 
-# Load environment variables
+# Load environment variables. Provider packages (langchain_openai, langchain_google_genai,
+# langchain_community) are imported, and their API keys read, only when one of their models
+# is first used, so importing ter_lib stays fast and needs no keys.
 load_dotenv(find_dotenv())
-openai.api_key = os.environ["OPENAI_API_KEY"]
-zhipu_api_key = os.environ["ZHIPUAI_API_KEY"]
 # Define model endpoints
 MODEL_ENDPOINTS = {
-    'openai': ['gpt-4','gpt-4o', 'gpt-4-1106-preview', 'gpt-3.5-turbo-0613', 'gpt-3.5-turbo'],
+    'openai': ['gpt-4','gpt-4o', 'gpt-4o-mini', 'gpt-4-1106-preview', 'gpt-3.5-turbo-0613', 'gpt-3.5-turbo'],
     'google': ['gemini-pro'],
-    'zhipu' : ['glm-4-0520', 'glm-4-air']
+    'zhipu' : ['glm-4-0520', 'glm-4-air'],
+    'fake'  : ['fake']
 }
+# Factories for extra providers, e.g. a local fake backend (see register_backend)
+LLM_BACKENDS = {}
+# LLM clients shared by every TEaR module of a run, keyed by model and settings
+_llm_clients = {}
+_llm_clients_lock = threading.Lock()
+# Optional on-disk response cache (llm_cache.ResponseCache), see set_response_cache
+response_cache = None
+# Optional rate limiter with retry/backoff (scheduler.RequestScheduler), see set_scheduler
+request_scheduler = None
+# Optional per-call metrics (metrics.MetricsRecorder), see set_metrics
+metrics_recorder = None
+# Optional severity-weighted refine threshold and compact mqm_info (mqm.MQMPolicy), see set_mqm_policy
+mqm_policy = None
+# Optional duplicate requests for slow or failed calls (hedge.HedgePolicy), see set_hedge_policy
+hedge_policy = None
 
 
 def read_json(path):
     with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def generate_ans(model, module, prompt, parser):
-    
-    if model in MODEL_ENDPOINTS['openai']:
-        llm = ChatOpenAI(model_name=model, verbose=True)
-    elif model in MODEL_ENDPOINTS['google']:
-        llm = ChatGoogleGenerativeAI(model=model, verbose=True)
-    elif model in MODEL_ENDPOINTS['zhipu']:
-        llm = ChatZhipuAI(model=model, api_key = zhipu_api_key,verbose=True)
-    else:
-        raise AssertionError("please add your model in ter_lib.py")
-
-    ans = llm.invoke(input=prompt)
-    ans = ans.content
+def register_backend(provider, models, factory):
+    # factory(model, **kwargs) must return an object whose invoke(input=prompt) returns a message with .content
+    MODEL_ENDPOINTS.setdefault(provider, [])
+    for model in models:
+        if model not in MODEL_ENDPOINTS[provider]:
+            MODEL_ENDPOINTS[provider].append(model)
+    LLM_BACKENDS[provider] = factory
+    with _llm_clients_lock:
+        for key in [key for key in _llm_clients if key[0] in models]:
+            del _llm_clients[key]
+
+def get_provider(model):
+    for provider, models in MODEL_ENDPOINTS.items():
+        if model in models:
+            return provider
+    raise AssertionError("please add your model in ter_lib.py")
+
+def build_llm(model, **kwargs):
+    provider = get_provider(model)
+    if provider in LLM_BACKENDS:
+        return LLM_BACKENDS[provider](model, **kwargs)
+    if request_scheduler is not None and provider in ('openai', 'google'):
+        # The scheduler retries; a client retrying on its own would hide 429s from its
+        # circuit breaker and retry counts
+        kwargs.setdefault('max_retries', 0)
+    if provider == 'openai':
+        # Reads OPENAI_API_KEY
+        from langchain_openai.chat_models import ChatOpenAI
+        return ChatOpenAI(model_name=model, verbose=True, **kwargs)
+    elif provider == 'google':
+        # Reads GOOGLE_API_KEY
+        from langchain_google_genai import ChatGoogleGenerativeAI
+        return ChatGoogleGenerativeAI(model=model, verbose=True, **kwargs)
+    elif provider == 'zhipu':
+        from langchain_community.chat_models import ChatZhipuAI
+        assert os.environ.get("ZHIPUAI_API_KEY"), "please set ZHIPUAI_API_KEY in .env"
+        return ChatZhipuAI(model=model, api_key=os.environ["ZHIPUAI_API_KEY"], verbose=True, **kwargs)
+    elif provider == 'fake':
+        from fake_llm import FakeChatModel
+        return FakeChatModel(model=model, **kwargs)
+
+def get_llm(model, **kwargs):
+    # Clients are built once and reused, so their HTTP connection pools stay alive across calls
+    key = (model, json.dumps(kwargs, sort_keys=True, default=str))
+    with _llm_clients_lock:
+        if key not in _llm_clients:
+            _llm_clients[key] = build_llm(model, **kwargs)
+        return _llm_clients[key]
+
+def clear_llm_clients():
+    with _llm_clients_lock:
+        _llm_clients.clear()
+
+def set_response_cache(cache):
+    global response_cache
+    response_cache = cache
+
+def set_scheduler(scheduler):
+    global request_scheduler
+    request_scheduler = scheduler
+    # Clients are built with or without their own retries depending on the scheduler
+    clear_llm_clients()
+
+def set_metrics(recorder):
+    global metrics_recorder
+    metrics_recorder = recorder
+
+def set_mqm_policy(policy):
+    global mqm_policy
+    mqm_policy = policy
+
+def set_hedge_policy(policy):
+    global hedge_policy
+    hedge_policy = policy
+
+def get_token_usage(message):
+    # (prompt tokens, completion tokens) reported by the provider, None if unknown
+    usage = getattr(message, 'usage_metadata', None)
+    if usage:
+        return usage.get('input_tokens'), usage.get('output_tokens')
+    usage = (getattr(message, 'response_metadata', None) or {}).get('token_usage')
+    if usage:
+        return usage.get('prompt_tokens'), usage.get('completion_tokens')
+    return None, None
+
+def call_llm(model, prompt, on_attempt=None, **llm_kwargs):
+    # One request to the model; returns the LLM message and {'queue_wait', 'retries'} of the call.
+    # on_attempt is passed to RequestScheduler.call (see hedge.HedgePolicy)
+    llm = get_llm(model, **llm_kwargs)
+    if request_scheduler is None:
+        if on_attempt is not None:
+            on_attempt(True)
+        return llm.invoke(input=prompt), {'queue_wait': 0.0, 'retries': 0}
+
+    provider = get_provider(model)
+    tokens = estimate_tokens(prompt)
+    message, info = request_scheduler.call(provider, lambda: llm.invoke(input=prompt), tokens=tokens, on_attempt=on_attempt)
+    prompt_tokens, completion_tokens = get_token_usage(message)
+    request_scheduler.record_usage(provider, tokens, (prompt_tokens or 0) + (completion_tokens or 0))
+    return message, info
+
+def invoke_llm(model, module, prompt, **llm_kwargs):
+    # Like call_llm, but hedged when a hedge policy is set; info then also has 'answered_by'
+    if hedge_policy is None:
+        return call_llm(model, prompt, **llm_kwargs)
+
+    def abandoned(model, message, info, wall):
+        # The losing request of a hedged call is billed too
+        if metrics_recorder is not None:
+            prompt_tokens, completion_tokens = get_token_usage(message)
+            if prompt_tokens is None:
+                prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(message.content)
+            metrics_recorder.record_call(f"{module}/abandoned", model, wall, info['queue_wait'], prompt_tokens, completion_tokens, info['retries'])
+
+    hedge_model = hedge_policy.fallback or model
+    return hedge_policy.call(model, get_provider(model), lambda model, on_attempt: call_llm(model, prompt, on_attempt, **llm_kwargs),
+                             hedge_model, get_provider(hedge_model), abandoned)
+
+def generate_ans(model, module, prompt, parser, **llm_kwargs):
+    start = time.perf_counter()
+    info = {'queue_wait': 0.0, 'retries': 0}
+    prompt_tokens, completion_tokens = 0, 0
+
+    ans = None
+    if response_cache is not None:
+        cache_key = response_cache.make_key(model, module, prompt, llm_kwargs)
+        ans = response_cache.get(cache_key)
+    cached = ans is not None
+
+    answered_by = model
+    if not cached:
+        ans, info = invoke_llm(model, module, prompt, **llm_kwargs)
+        answered_by = info.get('answered_by', model)
+        prompt_tokens, completion_tokens = get_token_usage(ans)
+        if prompt_tokens is None:
+            prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(ans.content)
+        ans = ans.content
     print(prompt)
 
-    if module == 'translate':
+    # Only answers that parse are cached, so a bad answer is asked again next time
+    try:
         ans_dict = parser.parse(ans)
+    except Exception:
+        if metrics_recorder is not None:
+            metrics_recorder.record_call(module, answered_by, time.perf_counter() - start, info['queue_wait'], prompt_tokens, completion_tokens, info['retries'], parse_failure=True, cache_hit=cached)
+        raise
+    if response_cache is not None and not cached:
+        # A hedged call may have been answered by the fallback model: cache it as that model's answer
+        if answered_by != model:
+            cache_key = response_cache.make_key(answered_by, module, prompt, llm_kwargs)
+        response_cache.put(cache_key, answered_by, module, ans)
+    if metrics_recorder is not None:
+        metrics_recorder.record_call(module, answered_by, time.perf_counter() - start, info['queue_wait'], prompt_tokens, completion_tokens, info['retries'], cache_hit=cached)
+
+    return format_ans(module, ans, ans_dict)
+
+def format_ans(module, ans, ans_dict):
+    # Turn a parsed answer into what generate_ans returns for the module
+    if module == 'translate':
         ans_mt = ans_dict['Target']
         # print(f"Translate: {ans_mt}")
         return ans_mt
 
     elif module == 'estimate':
-        ans_dict = parser.parse(ans)
-        all_no_error = all(value == "no-error" or value == '' or value == "null" or value == None for value in ans_dict.values())
-        if all_no_error:
-            # print("No need for correction")
-            nc = 0
-        else:
-            nc = 1
+        if mqm_policy is not None:
+            return mqm_policy.apply(ans, ans_dict)
+        nc = need_correction(ans_dict)
         # print(f"Estimate: {ans}")
         return ans, nc
 
+    elif module == 'estimate-batch':
+        # One (mqm_info, nc) per pair, in the order they were put in the prompt
+        results = []
+        for item in ans_dict['annotations']:
+            item_dict = {key: item.get(key) for key in ('critical', 'major', 'minor')}
+            if mqm_policy is not None:
+                results.append(mqm_policy.apply(json.dumps(item_dict, ensure_ascii=False), item_dict))
+            else:
+                results.append((json.dumps(item_dict, ensure_ascii=False), need_correction(item_dict)))
+        return results
+
     elif module == 'refine':
-        ans_dict = parser.parse(ans)
         ans_mt = ans_dict['Final Target']
         # print(f"Refine: {ans_mt}")
         return ans_mt
 
+def need_correction(ans_dict):
+    all_no_error = all(value == "no-error" or value == '' or value == "null" or value == None for value in ans_dict.values())
+    return 0 if all_no_error else 1
+
+def estimate_batch(E, src_lan, tgt_lan, srcs, hyps, model=None, errors=False):
+    # Estimate several pairs with one request; a batch whose answer does not parse
+    # is split in halves and retried, down to the single-pair estimate prompt. model defaults to E.model.
+    # With errors=True, a pair whose single-pair estimate still fails gets its ValueError instead of raising
+    model = model or E.model
+    if len(srcs) == 1:
+        json_parser, json_output_instructions = E.set_parser()
+        E_messages = E.fill_prompt(src_lan, tgt_lan, srcs[0], json_output_instructions, hyp=hyps[0])
+        try:
+            return [generate_ans(model, 'estimate', E_messages, json_parser)]
+        except ValueError as e:
+            if not errors:
+                raise
+            return [e]
+
+    json_parser, json_output_instructions = E.set_parser(batch_size=len(srcs))
+    E_messages = E.fill_batch_prompt(src_lan, tgt_lan, srcs, hyps, json_output_instructions)
+    try:
+        return generate_ans(model, 'estimate-batch', E_messages, json_parser)
+    except ValueError as e:
+        print(f"Batch estimate of {len(srcs)} pairs failed ({e}), splitting")
+        half = len(srcs) // 2
+        return (estimate_batch(E, src_lan, tgt_lan, srcs[:half], hyps[:half], model, errors) +
+                estimate_batch(E, src_lan, tgt_lan, srcs[half:], hyps[half:], model, errors))
+
+def escalates(mqm_info, severities):
+    from mqm import parse_mqm_info
+    return any(error.severity in severities for error in parse_mqm_info(mqm_info))
+
+def estimate_pairs(E, src_lan, tgt_lan, srcs, hyps):
+    # [(mqm_info, nc)] of the pairs. With a cascade (E.set_cascade), the pairs in which E.model finds
+    # errors of the escalation severities, or whose answer does not parse, are estimated again on
+    # the cascade model; every pair's decision, latency and cost is reported to the metrics
+    if E.cascade is None:
+        return estimate_batch(E, src_lan, tgt_lan, srcs, hyps)
+    strong_model, severities = E.cascade
+    collect = metrics_recorder.collect if metrics_recorder is not None else lambda: nullcontext([])
+
+    start = time.perf_counter()
+    with collect() as first_calls:
+        # Only the pairs that still fail on their own are escalated as parse failures
+        estimates = estimate_batch(E, src_lan, tgt_lan, srcs, hyps, errors=True)
+    first_wall = time.perf_counter() - start
+    routes = []
+    for estimate in estimates:
+        if isinstance(estimate, ValueError):
+            print(f"Estimate on {E.model} failed ({estimate}), escalating to {strong_model}")
+            routes.append('parse failure')
+        else:
+            routes.append('escalated' if escalates(estimate[0], severities) else 'kept')
+    # The first (possibly batched) call is shared by its pairs
+    share = 1 / len(srcs)
+
+    for i, route in enumerate(routes):
+        start = time.perf_counter()
+        with collect() as calls:
+            if route != 'kept':
+                estimates[i] = estimate_batch(E, src_lan, tgt_lan, [srcs[i]], [hyps[i]], strong_model)[0]
+        if metrics_recorder is not None:
+            metrics_recorder.record_route('estimate', route, first_wall + time.perf_counter() - start,
+                                          len(first_calls) * share + len(calls),
+                                          sum(call['cost'] for call in first_calls) * share + sum(call['cost'] for call in calls))
+    return estimates
+
+def run_tear(T, E, R, src_lan, tgt_lan, src_text):
+    # Load examples and set parser
+    examples = T.examples_for(src_text)
+    json_parser, json_output_instructions = T.set_parser()
+
+    # Translate
+    T_messages = T.fill_prompt(src_lan, tgt_lan, src_text, json_output_instructions, examples)
+    hyp = generate_ans(T.model, 'translate', T_messages, json_parser)
+
+    # Estimate
+    mqm_info, nc = estimate_pairs(E, src_lan, tgt_lan, [src_text], [hyp])[0]
+
+    # Refine if necessary
+    if nc == 1:
+        json_parser, json_output_instructions = R.set_parser()
+        R_messages = R.fill_prompt(src_lan, tgt_lan, src_text, json_output_instructions, examples, hyp, mqm_info)
+        cor = generate_ans(R.model, 'refine', R_messages, json_parser)
+    elif nc == 0:
+        cor = hyp
+
+    return hyp, cor, nc, mqm_info
+
+def run_tear_batch(T, E, R, src_lan, tgt_lan, src_texts):
+    # Same as run_tear for several segments, with a single batched estimate request
+    if len(src_texts) == 1:
+        return [run_tear(T, E, R, src_lan, tgt_lan, src_texts[0])]
+
+    # Load examples and set parser
+    examples = [T.examples_for(src_text) for src_text in src_texts]
+    json_parser, json_output_instructions = T.set_parser()
+
+    # Translate
+    hyps = []
+    for src_text, src_examples in zip(src_texts, examples):
+        T_messages = T.fill_prompt(src_lan, tgt_lan, src_text, json_output_instructions, src_examples)
+        hyps.append(generate_ans(T.model, 'translate', T_messages, json_parser))
+
+    # Estimate
+    estimates = estimate_pairs(E, src_lan, tgt_lan, src_texts, hyps)
+
+    # Refine if necessary
+    results = []
+    json_parser, json_output_instructions = R.set_parser()
+    for src_text, src_examples, hyp, (mqm_info, nc) in zip(src_texts, examples, hyps, estimates):
+        if nc == 1:
+            R_messages = R.fill_prompt(src_lan, tgt_lan, src_text, json_output_instructions, src_examples, hyp, mqm_info)
+            cor = generate_ans(R.model, 'refine', R_messages, json_parser)
+        elif nc == 0:
+            cor = hyp
+        results.append((hyp, cor, nc, mqm_info))
+    return results
+
+def ordered_map(func, items, workers=1, window=None):
+    # Run func over items with `workers` threads and yield results in input order.
+    # At most `window` items are in flight, so results can be written out as soon as
+    # the head of the queue is done and a resumed run sees a contiguous prefix.
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    window = window or 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(pool.submit(func, item))
+            if len(in_flight) >= window:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+class BatchOutputParser:
+    # Parser of a batched estimate answer, which must hold exactly one annotation per pair
+    def __init__(self, parser, batch_size):
+        self.parser = parser
+        self.batch_size = batch_size
+
+    def get_format_instructions(self):
+        return self.parser.get_format_instructions()
+
+    def parse(self, text):
+        ans_dict = self.parser.parse(text)
+        items = ans_dict.get('annotations')
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("annotations is not a list of objects")
+        try:
+            items = sorted(items, key=lambda item: int(item['id']))
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("annotation without a valid id")
+        if [int(item['id']) for item in items] != list(range(1, self.batch_size + 1)):
+            raise ValueError(f"expected annotations for ids 1..{self.batch_size}")
+        # An annotation without its severities would read as "no error" and never be refined
+        items = [{str(key).lower(): value for key, value in item.items()} for item in items]
+        for item in items:
+            if not all(severity in item for severity in ('critical', 'major', 'minor')):
+                raise ValueError(f"annotation {item['id']} lacks critical/major/minor")
+        ans_dict['annotations'] = items
+        return ans_dict
+
 class TEaR:
     def __init__(self, lang_pair, model, module, strategy, prompt_path='./prompts/'):
         self.lang_pair = lang_pair
@@ -71,13 +401,50 @@ class TEaR:
         self.strategy = strategy
         with open(os.path.join(prompt_path, f'{self.module}/{self.strategy}.txt'), 'r', encoding='utf-8') as f:
             raw_template = f.read()
-        self.template = self.form_template(raw_template)
+        self.raw_template = raw_template
+        self.prompt_path = prompt_path
+        # Few-shot examples, parsers and format instructions are the same for every segment
+        self._template = None
+        self.examples = None
+        self.retriever = None
+        self.cascade = None
+        self.parsers = {}
+        self.batch_template = None
+
+    @property
+    def template(self):
+        # LangChain PromptTemplate of the raw template, built on first use (fill_prompt does not need it)
+        if self._template is None:
+            self._template = self.form_template(self.raw_template)
+        return self._template
 
     def form_template(self, raw_template):
+        from langchain.prompts import PromptTemplate
         temp = PromptTemplate.from_template(template=raw_template)
         return temp
 
     def load_examples(self):
+        if self.examples is None:
+            self.examples = self.read_examples()
+        return self.examples
+
+    def set_retriever(self, index, k=4, max_tokens=250):
+        # Retrieve the examples of each source sentence from a shot_index.ShotIndex instead of using the whole shots file
+        self.retriever = (index, k, max_tokens)
+
+    def set_cascade(self, model, severities=('critical', 'major')):
+        # Estimate module only: re-estimate on `model` when self.model reports errors of these severities or fails to parse
+        assert self.module == 'estimate', "only the estimate module supports a cascade"
+        get_provider(model)
+        self.cascade = (model, tuple(severities))
+
+    def examples_for(self, src):
+        if self.retriever is None or self.strategy != 'few-shot':
+            return self.load_examples()
+        index, k, max_tokens = self.retriever
+        return index.examples(src, k, max_tokens)
+
+    def read_examples(self):
         try:
             if self.strategy == 'few-shot':
                 qr_fewshot_path = f"prompts/data-shots/mt/shots.{self.lang_pair}.json"
@@ -100,7 +467,19 @@ class TEaR:
 
         return cases_formatted
 
-    def set_parser(self):
+    def set_parser(self, batch_size=None):
+        if batch_size not in self.parsers:
+            self.parsers[batch_size] = self.build_parser(batch_size)
+        return self.parsers[batch_size]
+
+    def build_parser(self, batch_size=None):
+        from langchain.output_parsers.structured import ResponseSchema, StructuredOutputParser
+        if self.module == 'estimate' and batch_size:
+            ans_schema = ResponseSchema(name="annotations", type="array", description=f"A list of {batch_size} objects, one per translation pair in the given order. Each object has the keys \"id\" (the number of the pair), \"critical\" (critical errors), \"major\" (major errors) and \"minor\" (minor errors).")
+            json_parser = BatchOutputParser(StructuredOutputParser.from_response_schemas([ans_schema]), batch_size)
+            json_output_instructions = json_parser.get_format_instructions()
+            return json_parser, json_output_instructions
+
         if self.module == 'translate':
             ans_schema = ResponseSchema(name="Target", description="The final translation. Please use escape characters for the quotation marks in the sentence.")
             json_parser = StructuredOutputParser.from_response_schemas([ans_schema])
@@ -121,14 +500,28 @@ class TEaR:
         return json_parser, json_output_instructions
 
     def fill_prompt(self, src_lan, tgt_lan, src, json_output_instructions, examples=None, hyp=None, mqm_info=None):
+        # Templates are plain f-string templates, so str.format renders them the same way
+        # PromptTemplate.format does, without its per-call validation overhead
         if self.module == 'translate':
-            write_prompt = self.template
-            prompt = write_prompt.format(src_lan=src_lan, tgt_lan=tgt_lan, examples=examples, origin=src.strip(), format_instructions=json_output_instructions)
+            prompt = self.raw_template.format(src_lan=src_lan, tgt_lan=tgt_lan, examples=examples, origin=src.strip(), format_instructions=json_output_instructions)
         elif self.module == 'estimate':
-            write_prompt = self.template
-            prompt = write_prompt.format(src_lan=src_lan, tgt_lan=tgt_lan, origin=src.strip(), trans=hyp, format_instructions=json_output_instructions)
+            prompt = self.raw_template.format(src_lan=src_lan, tgt_lan=tgt_lan, origin=src.strip(), trans=hyp, format_instructions=json_output_instructions)
         elif self.module == 'refine':
-            write_prompt = self.template
-            prompt = write_prompt.format(src_lan=src_lan, tgt_lan=tgt_lan, examples=examples, raw_src=src.strip(), raw_mt=hyp, sent_mqm=mqm_info, format_instructions=json_output_instructions)
+            prompt = self.raw_template.format(src_lan=src_lan, tgt_lan=tgt_lan, examples=examples, raw_src=src.strip(), raw_mt=hyp, sent_mqm=mqm_info, format_instructions=json_output_instructions)
         return prompt
 
+    def fill_batch_prompt(self, src_lan, tgt_lan, srcs, hyps, json_output_instructions):
+        # Batched estimate prompt: the instructions (and MQM examples) of the estimate template
+        # are sent once, followed by the numbered source/translation pairs
+        assert self.module == 'estimate', "only the estimate module supports batched prompts"
+        if self.batch_template is None:
+            # The head is everything of the template before its first source/translation pair
+            marker = '{src_lan} source: {origin}'
+            template_path = os.path.join(self.prompt_path, f'{self.module}/{self.strategy}.txt')
+            assert marker in self.raw_template, f"{template_path} cannot be batched: it has no \"{marker}\" line"
+            with open(os.path.join(self.prompt_path, 'estimate/batch.txt'), 'r', encoding='utf-8') as f:
+                self.batch_template = (self.raw_template.split(marker)[0], f.read())
+        head, tail = self.batch_template
+        items = '\n\n'.join(f"[{i + 1}]\n{src_lan} source: {src.strip()}\n{tgt_lan} translation: {hyp}" for i, (src, hyp) in enumerate(zip(srcs, hyps)))
+        prompt = head.format(src_lan=src_lan, tgt_lan=tgt_lan) + tail.format(n=len(srcs), items=items, format_instructions=json_output_instructions)
+        return prompt